@@ -1,4 +1,5 @@
-import ics.utils.time as pfsTime
+import importlib
+
 import opscore.protocols.keys as keys
 import opscore.protocols.types as types
 from ics.iicActor.utils import exception
@@ -22,6 +23,9 @@ class SequenceCmd(object):
             ('sequence', '@finish [<id>] [@(now)]', self.finishSequence),
             ('sequence', '@continue <id>', self.restartSequence),
             ('sequence', '@copy <id>', self.restartSequence),
+            ('sequence', '@resume <id>', self.resumeSequence),
+            ('sequence', '@latency [<seqtype>]', self.sequenceLatency),
+            ('subCmd', '@latency [<actor>] [<cmdHead>]', self.subCmdLatency),
             ('sps', '@abortExposure [<id>] [@(sunss)]', self.abortSpsExposure),
             ('sps', '@finishExposure [@(now)] [<id>] [@(sunss)]', self.finishSpsExposure),
             ('sps', 'waitForSequenceCompletion [<id>]', self.waitForSequenceCompletion),
@@ -33,6 +37,9 @@ class SequenceCmd(object):
         self.keys = keys.KeysDictionary("iic_sequence", (1, 1),
                                         keys.Key('id', types.Int(), help='optional sequence_id.'),
                                         keys.Key('groupName', types.String(), help='group identifier'),
+                                        keys.Key('seqtype', types.String(), help='sequence type'),
+                                        keys.Key('actor', types.String(), help='subcommand actor'),
+                                        keys.Key('cmdHead', types.String(), help='subcommand head'),
                                         )
 
     @property
@@ -105,6 +112,7 @@ class SequenceCmd(object):
         # make a copy using the saved cmdKeys and set the same cmdStr as the original.
         copy = sequence.fromCmdKeys(self.actor, sequence.cmdKeys)
         copy.cmdStr = sequence.cmdStr
+        copy.rawCmd = sequence.rawCmd
 
         if 'continue' in cmdKeys:
             # indicate that this sequence is an extension.
@@ -112,12 +120,105 @@ class SequenceCmd(object):
             copy.comments = f'continue {sequenceId}'
 
             # do not re-execute already successful subcommands.
-            for i in range(len(sequence.cmdList)):
-                if sequence.cmdList[i].cmdRet.succeed:
-                    copy.cmdList[i].cmdRet.status = 0
+            copy.materialize(sequence.nCmds)
+
+            for i in range(sequence.nCmds):
+                if sequence.subCmdAt(i).cmdRet.succeed:
+                    copy.subCmdAt(i).cmdRet.status = 0
+
+            # statuses were modified in place.
+            copy.recount()
 
         self.engine.runInThread(cmd, copy)
 
+    def resumeSequence(self, cmd):
+        """
+        `iic sequence resume id=N`
+
+        resume an iic sequence from the local journal, typically after an actor restart.
+
+        Parameters
+        ---------
+        id : `int`
+           sequenceId.
+        """
+        cmdKeys = cmd.cmd.keywords
+        sequenceId = int(cmdKeys['id'].values[0])
+
+        try:
+            definition, succeeded = self.engine.journal.lookup(sequenceId)
+            # rebuild cmdKeys from the original command.
+            validatedCmd, __ = self.actor.handler.match(definition['rawCmd'])
+            module = importlib.import_module(definition['module'])
+            seqClass = getattr(module, definition['className'])
+            copy = seqClass.fromCmdKeys(self.actor, validatedCmd.keywords)
+        except Exception as e:
+            cmd.fail(f'text="could not resume sequence {sequenceId}: {str(e)}"')
+            return
+
+        # closed in the journal only once the copy has started, so it can still be resumed if the copy is rejected.
+        copy.resumedFrom = sequenceId
+        copy.cmdStr = definition['cmdStr']
+        copy.rawCmd = definition['rawCmd']
+        # indicate that this sequence is an extension.
+        copy.seqtype = f"{definition['seqtype'].replace('_continued', '')}_continued"
+        copy.comments = f'resume {sequenceId}'
+
+        # do not re-execute already successful subcommands.
+        copy.materialize(max(succeeded, default=-1) + 1)
+
+        for i in range(copy.nCmds):
+            if i in succeeded:
+                copy.subCmdAt(i).cmdRet.status = 0
+
+        # statuses were modified in place.
+        copy.recount()
+
+        self.engine.runInThread(cmd, copy)
+
+    def sequenceLatency(self, cmd):
+        """
+        `iic sequence latency [seqtype=XXX]`
+
+        report engine phase durations over the last sequences.
+
+        Parameters
+        ---------
+        seqtype : `str`
+           optional sequence type.
+        """
+        cmdKeys = cmd.cmd.keywords
+        seqtype = cmdKeys['seqtype'].values[0] if 'seqtype' in cmdKeys else None
+
+        nRows = self.engine.latency.genKeys(cmd, seqtype=seqtype)
+        cmd.finish(f'text="{nRows} phase histograms"')
+
+    @singleShot
+    def subCmdLatency(self, cmd):
+        """
+        `iic subCmd latency [actor=XXX] [cmdHead=XXX]`
+
+        report subcommand round-trip percentiles from the ledger.
+
+        Parameters
+        ---------
+        actor : `str`
+           optional actor.
+        cmdHead : `str`
+           optional command head.
+        """
+        cmdKeys = cmd.cmd.keywords
+        actor = cmdKeys['actor'].values[0] if 'actor' in cmdKeys else None
+        cmdHead = cmdKeys['cmdHead'].values[0] if 'cmdHead' in cmdKeys else None
+
+        try:
+            nRows = self.engine.ledger.genKeys(cmd, actor=actor, cmdHead=cmdHead)
+        except Exception as e:
+            cmd.fail(f'text="{str(e)}"')
+            return
+
+        cmd.finish(f'text="{nRows} subcommand types"')
+
     @singleShot
     def abortSpsExposure(self, cmd):
         """
@@ -205,13 +306,17 @@ class SequenceCmd(object):
             cmd.finish('text="could not identify sequence with returnWhenShutterClose set, finishing now..."')
             return
 
-        start = pfsTime.timestamp()
+        # evaluated once, the sequence cannot take any longer than that.
+        timeLim = sequence.timeLim
 
-        while not sequence.cmd is None:
-            if pfsTime.timestamp() - start > sequence.timeLim:
-                raise RuntimeError(f'Sequence did not return when shutter close after {sequence.timeLim} s')
+        # woken up as soon as the command is released or the sequence is concluded.
+        if not sequence.status.waitFor(lambda: sequence.cmd is None or not sequence.status.isActive, timeout=timeLim):
+            cmd.fail(f'text="Sequence did not return when shutter close after {timeLim} s"')
+            return
 
-            pfsTime.sleep.millisec()
+        if not sequence.status.isActive and sequence.cmd is not None:
+            cmd.finish('text="sequence already concluded, finishing now..."')
+            return
 
         # attaching the command to the active sequence.
         sequence.setCmd(cmd)
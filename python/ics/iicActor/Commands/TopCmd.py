@@ -1,6 +1,7 @@
 import numpy as np
 import opscore.protocols.keys as keys
 import opscore.protocols.types as types
+from ics.utils.threading import singleShot
 from pfs.datamodel import PfsDesign
 from pfs.utils.pfsDesignVariants import makeVariantDesign
 
@@ -26,6 +27,9 @@ class TopCmd(object):
             ('getMaxVariants', '<designId0>', self.getMaxVariants),
             ('finishField', '', self.finishField),
             ('ingestPfsDesign', '<designId> [<designedAt>] [<toBeObservedAt>]', self.ingestPfsDesign),
+            ('opdb', '@flush [<timeout>]', self.flushOpdb),
+            ('opdb', '@statements', self.opdbStatements),
+            ('opdb', '@invalidate', self.invalidateOpdbCache),
         ]
 
         # Define typed command arguments for the above commands.
@@ -41,6 +45,7 @@ class TopCmd(object):
                                         keys.Key('caller', types.String(), help='visit caller'),
                                         keys.Key('designedAt', types.String(), help=''),
                                         keys.Key('toBeObservedAt', types.String(), help=''),
+                                        keys.Key('timeout', types.Float(), help='timeout in seconds'),
                                         )
 
     @property
@@ -63,6 +68,48 @@ class TopCmd(object):
         """Report camera status and actor version."""
         self.actor.sendVersionKey(cmd)
         self.actor.genPfsDesignKey(cmd)
+        self.engine.executor.genKeys(cmd)
+        self.engine.admission.genKeys(cmd)
+        self.engine.resourceManager.genKeys(cmd)
+        self.engine.opdb.pool.genKeys(cmd)
+
+        if self.engine.opdb.writeBehind is not None:
+            self.engine.opdb.writeBehind.genKeys(cmd)
+
+        self.actor.genStartupKeys(cmd)
+
+        cmd.finish()
+
+    def opdbStatements(self, cmd):
+        """Report number of calls, mean and max time in ms for each opdb statement."""
+        self.engine.opdb.queries.genKeys(cmd)
+        self.engine.opdb.pool.genKeys(cmd)
+        self.engine.opdb.genCacheKeys(cmd)
+        cmd.finish()
+
+    def invalidateOpdbCache(self, cmd):
+        """Forget cached group names and group ids, next lookups will query opdb."""
+        self.engine.opdb.invalidateGroupCache()
+        self.engine.opdb.genCacheKeys(cmd)
+        cmd.finish()
+
+    @singleShot
+    def flushOpdb(self, cmd):
+        """Wait for background opdb inserts to be written."""
+        cmdKeys = cmd.cmd.keywords
+        timeout = cmdKeys['timeout'].values[0] if 'timeout' in cmdKeys else 60
+        writeBehind = self.engine.opdb.writeBehind
+
+        if writeBehind is None:
+            cmd.finish('text="opdb write-behind is disabled, nothing to flush"')
+            return
+
+        isFlushed = writeBehind.flush(timeout=timeout)
+        writeBehind.genKeys(cmd)
+
+        if not isFlushed:
+            cmd.fail(f'text="opdb inserts still pending after {timeout} s"')
+            return
 
         cmd.finish()
 
@@ -1,18 +1,19 @@
 #!/usr/bin/env python3
 
 import os
+import time
 
 import actorcore.ICC
 import ics.iicActor.utils.pfsDesign.merge as mergeDesign
 import numpy as np
 import pandas as pd
 from ics.iicActor.utils import engine
+from ics.iicActor.utils import exception
 from ics.iicActor.utils import keyBuffer
 from ics.utils.sps.spectroIds import getSite
 from pfs.datamodel.pfsConfig import PfsDesign, TargetType
 from pfs.utils.fiberids import FiberIds
 from pfs.utils.pfsConfigUtils import getDateDir
-from twisted.internet import reactor
 
 
 class IicActor(actorcore.ICC.ICC):
@@ -20,6 +21,9 @@ class IicActor(actorcore.ICC.ICC):
                  productName=None,
                  debugLevel=30):
         """ Setup an Actor instance. See help for actorcore.Actor for details. """
+        # start-up profile, monotonic timestamps for each step until ready.
+        self.startedAt = time.monotonic()
+        self.startupSteps = []
 
         # This sets up the connections to/from the hub, the logger, and the twisted reactor.
         #
@@ -36,6 +40,7 @@ class IicActor(actorcore.ICC.ICC):
         self.buffer = keyBuffer.KeyBuffer(self)
 
         self.everConnected = False
+        self.startupSteps.append(('init', time.monotonic()))
 
     @property
     def visitManager(self):
@@ -49,44 +54,82 @@ class IicActor(actorcore.ICC.ICC):
     def pfiConnected(self):
         return 'pfi' in self.buffer.lightSources
 
+    @property
+    def startupTiming(self):
+        """Time spent on each start-up step, in seconds."""
+        previous = self.startedAt
+        timing = []
+
+        for step, timestamp in self.startupSteps:
+            timing.append((step, timestamp - previous))
+            previous = timestamp
+
+        return timing
+
     @property
     def scrLightsOn(self):
         status = self.models['scr'].keyVarDict['scrLights'].getValue()
         return status == 'on'
 
+    @property
+    def liveINSROT(self):
+        """Current instrument rotator angle from gen2 telemetry, None if not available."""
+        keyVar = self.models['gen2'].keyVarDict['tel_rot']
+
+        try:
+            posAngle, insrot = keyVar.getValue()
+        except (ValueError, TypeError):
+            return None
+
+        return float(insrot) if keyVar.isCurrent and insrot is not None else None
+
     def connectionMade(self):
         if self.everConnected is False:
             self.logger.info('Establishing first tron connection...')
             self.everConnected = True
 
+            specNums = range(1, 5)
             _needModels = [self.name, 'gen2', 'fps', 'mcs', 'ag', 'dcb', 'dcb2', 'iis', 'sunss', 'scr']
+            _needModels += [f'enu_sm{specNum}' for specNum in specNums] + [f'hx_n{specNum}' for specNum in specNums]
+            # registering all models in one pass.
             self.logger.info(f'adding models: {sorted(_needModels)}')
             self.addModels(_needModels)
             self.logger.info(f'added models: {sorted(self.models.keys())}')
+            self.startupSteps.append(('models', time.monotonic()))
 
             self.site = getSite()
             self.logger.info(f'site :{self.site}')
 
-            for spectrographId in range(1, 5):
-                enuActor = f'enu_sm{spectrographId}'
-                self.addModels([enuActor])
-                self.addModels([f'hx_n{spectrographId}'])
-                self.buffer.attachCallback('sps', f'sm{spectrographId}LightSource', self._onDesignInputsChanged)
-                self.models[enuActor].keyVarDict['redResolution'].addCallback(self.engine.resourceManager.freeEnu)
+            for specNum in specNums:
+                self.buffer.attachCallback('sps', f'sm{specNum}LightSource', self._onDesignInputsChanged)
+                self.models[f'enu_sm{specNum}'].keyVarDict['redResolution'].addCallback(
+                    self.engine.resourceManager.freeEnu)
 
             for dcb in {'dcb', 'dcb2'}:
                 self.buffer.attachCallback(dcb, 'designId', self._onDesignInputsChanged)
 
             self.models['fps'].keyVarDict['pfsConfig'].addCallback(self.fpsConfigCB)
             self.models['sps'].keyVarDict['fiberIllumination'].addCallback(self.updateFiberIlluminationCB)
+            self.startupSteps.append(('callbacks', time.monotonic()))
 
-            reactor.callLater(1, self.letsGetReadyToRumble)
+            # models and callbacks exist now, no need to wait any longer for status.
+            self.letsGetReadyToRumble()
+            self.startupSteps.append(('status', time.monotonic()))
+
+            self.genStartupKeys(self.bcast)
 
     def letsGetReadyToRumble(self):
         """"""
         for actor in ['hub', 'sps', 'dcb', 'dcb2']:
             self.cmdr.bgCall(callFunc=None, actor=actor, cmdStr='status')
 
+    def genStartupKeys(self, cmd):
+        """Generate startupTiming keyword, time spent on each start-up step and total time to ready."""
+        timing = self.startupTiming
+        steps = ','.join([f'"{step}",{duration:.3f}' for step, duration in timing])
+        total = sum([duration for step, duration in timing])
+        cmd.inform(f'startupTiming={total:.3f},{steps}')
+
     def _onDesignInputsChanged(self, cmd=None, designedAt=None):
         """Called from callbacks only."""
         cmd = self.bcast if cmd is None else cmd
@@ -243,6 +286,12 @@ class IicActor(actorcore.ICC.ICC):
 
         if status == 'Done' and self.visitManager.activeField:
             self.visitManager.activeField.loadPfsConfig0(designId, visit0)
+            # INSROT reference for the whole field, fetched now so that exposures do not have to.
+            try:
+                self.engine.executor.submit(self.engine.opdb.fetchVisit0INSROT, visit0)
+            except exception.EngineQueueFull as e:
+                # first exposure will fetch it then.
+                self.bcast.warn(f'text="could not prefetch visit0 INSROT: {str(e)}"')
         elif status == 'inProgress' and self.visitManager.activeField:
             # Cobras are about to move, resetting pfsConfig0.
             self.visitManager.activeField.setPfsConfig0(None)
@@ -264,12 +313,11 @@ class IicActor(actorcore.ICC.ICC):
         spsExpose.updateFiberIllumination(fiberIlluminationStatus)
 
         # this is the last exposure of the sequence.
-        lastExposure = len(spsExpose.sequence.remainingExposures) == 1
+        lastExposure = spsExpose.sequence.nRemainingExposures == 1
 
         # Finish command immediately.
         if spsExpose.sequence.returnWhenShutterClose and lastExposure:
-            spsExpose.sequence.cmd.finish()
-            spsExpose.sequence.cmd = None
+            spsExpose.sequence.releaseCmd()
 
     def genPfsDesignKey(self, cmd):
         """Generate pfsDesign keyword."""
@@ -133,6 +133,8 @@ class FocusSweep(AgSequence):
 
     """
     seqtype = 'agFocusSweep'
+    # positions are added by further commands.
+    isResumable = False
     insertVisitSet = True
 
     def __init__(self, designId, exptime, fit_dScale, fit_dInR, exposure_delay, tec_off, **seqKeys):
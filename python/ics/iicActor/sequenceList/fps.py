@@ -14,19 +14,21 @@ class FpsSequence(VisitedSequence):
 
     def turnOnIlluminators(self, cableBLampOn=False, useBiaCallback=True):
         """Turn on the cobra illuminators."""
-        self.add('sps', 'bia callbackOn' if useBiaCallback else 'bia on')
-        self.add('peb', 'led on')
+        with self.parallel():
+            self.add('sps', 'bia callbackOn' if useBiaCallback else 'bia on')
+            self.add('peb', 'led on')
 
-        if cableBLampOn:
-            self.add('dcb', 'power on cableB')
+            if cableBLampOn:
+                self.add('dcb', 'power on cableB')
 
     def turnOffIlluminators(self, cableBLampOn=False, useBiaCallback=True):
         """Turn off the cobra illuminators."""
-        self.tail.add('sps', 'bia callbackOff' if useBiaCallback else 'bia off')
-        self.tail.add('peb', 'led off')
+        with self.parallel():
+            self.tail.add('sps', 'bia callbackOff' if useBiaCallback else 'bia off')
+            self.tail.add('peb', 'led off')
 
-        if cableBLampOn:
-            self.tail.add('dcb', 'power off cableB')
+            if cableBLampOn:
+                self.tail.add('dcb', 'power off cableB')
 
 
 class BoresightLoop(FpsSequence):
@@ -38,6 +40,8 @@ class BoresightLoop(FpsSequence):
 
     """
     seqtype = 'boresightLoop'
+    # positions are added by further commands.
+    isResumable = False
 
     def __init__(self, exptime, nExposures, **fpsKeys):
         super().__init__(**fpsKeys)
@@ -1,10 +1,10 @@
 import ics.iicActor.utils.translate as translate
 import numpy as np
 from ics.iicActor.sps.sequence import SpsSequence
-from ics.iicActor.utils.sequence import Sequence
+from ics.iicActor.utils.sequence import Sequence, StreamingSequence
 
 
-class HexapodStability(SpsSequence):
+class HexapodStability(StreamingSequence, SpsSequence):
     """ hexapod stability sequence """
     seqtype = 'hexapodStability'
 
@@ -28,16 +28,28 @@ class HexapodStability(SpsSequence):
         """
         SpsSequence.__init__(self, cams, **seqKeys)
 
-        # taking an exposure before starting hexapod, (only for the one that were off in the first place).
         cameraWithHexapodPowerCycled = [cam for cam in cams if cam.specName in hexapodOff]
+
+        # the grid is large, so steps are built only when needed.
+        nSteps = 3 + len(positions) * (1 + len(positions) * (1 + duplicate)) + 2 * duplicate
+        nSteps += 1 + 2 * duplicate if cameraWithHexapodPowerCycled else 0
+        steps = self.gridSteps(cams, lampsKeys, duplicate, positions, cameraWithHexapodPowerCycled)
+        self.stream(steps, nExpected=nSteps)
+
+    def gridSteps(self, cams, lampsKeys, duplicate, positions, cameraWithHexapodPowerCycled):
+        """Generate hexapod repeatability grid, one step at a time."""
+        # taking an exposure before starting hexapod, (only for the one that were off in the first place).
         if cameraWithHexapodPowerCycled:
             self.expose('arc', lampsKeys, cameraWithHexapodPowerCycled, duplicate=duplicate)
+            yield
 
         self.add('sps', 'slit start', cams=cams)
+        yield
 
         # taking one exposure in home.
         self.add('sps', 'slit home', cams=cams)
         self.expose('arc', lampsKeys, cams, duplicate=duplicate)
+        yield
 
         for pos in positions:
             # Move y once separately
@@ -45,10 +57,12 @@ class HexapodStability(SpsSequence):
             for pos in positions:
                 self.add('sps', 'slit dither', x=round(pos, 5), abs=True, cams=cams)
                 self.expose('arc', lampsKeys, cams, duplicate=duplicate)
+                yield
 
         # taking again an exposure in home
         self.add('sps', 'slit home', cams=cams)
         self.expose('arc', lampsKeys, cams, duplicate=duplicate)
+        yield
 
         # taking an exposure after the hexapod is turned back off (only for the one that were off in the first place).
         if cameraWithHexapodPowerCycled:
@@ -36,6 +36,8 @@ class ScienceObject(SpsSequence):
 
 class ScienceObjectLoop(ScienceObject):
     """ Biases sequence """
+    # subcommands are appended after completion, so resources must be kept until the very end.
+    incrementalRelease = False
 
     def __init__(self, cams, exptime, duplicate, windowKeys, mcsExposureBefore, **seqKeys):
         ScienceObject.__init__(self, cams, exptime, 1, windowKeys, mcsExposureBefore, **seqKeys)
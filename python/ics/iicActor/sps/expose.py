@@ -1,3 +1,4 @@
+import contextlib
 import logging
 
 import ics.utils.cmd as cmdUtils
@@ -84,24 +85,64 @@ class SpsExpose(VisitedCmd):
         """Set visit, process command, and finalize by inserting into visit_set."""
         with self.visitManager.getVisit(caller='sps') as visit:
             self.prepareVisit(visit)
-
-            if self.mcsExposureBefore and self.mcsExposureBefore['enabled'] and self.sequence.isPfiExposure:
-                self.callMcsExposure(cmd, visit, **self.mcsExposureBefore)
+            self.callMcsExposureBefore(cmd, visit)
 
             cmdRet = super().call(cmd)
+            self.concludeVisit()
 
-            # Insert into visit_set in the database
-            self.sequence.engine.opdb.insertVisitSet('sps', sequence_id=self.sequence.sequence_id,
-                                                     pfs_visit_id=self.visitId)
+        return cmdRet
 
-            # Write pfsConfig if required, should not happen but let's be careful.
-            if self.doWritePfsConfig:
-                self.writePfsConfig(self.pfsConfig)
+    def dispatch(self, cmd, callback):
+        """Non-blocking counterpart of call, no thread is held while exposing."""
+        self.iicActor.engine.executor.resume(self.dispatchVisited, cmd, callback)
 
-            # Release the visit as it is no longer active
-            self.release()
+    def dispatchVisited(self, cmd, callback):
+        """Set visit and dispatch command, visit is concluded once the exposure is done."""
+        visitContext = contextlib.ExitStack()
 
-        return cmdRet
+        try:
+            visit = visitContext.enter_context(self.visitManager.getVisit(caller='sps'))
+            self.prepareVisit(visit)
+            self.callMcsExposureBefore(cmd, visit)
+        except gen2.FetchVisitFromGen2 as e:
+            visitContext.close()
+            # converting to a consistent output.
+            lastReply = str(e)
+            return self.notify(callback, lambda: CmdRet(1, [lastReply], lastReply))
+        except Exception as e:
+            visitContext.close()
+            return callback(e)
+
+        def onDone(cmdVar):
+            with visitContext:
+                cmdRet = self.processReply(cmd, cmdVar)
+                self.concludeVisit()
+
+            return cmdRet
+
+        try:
+            self.bgCall(cmd, lambda cmdVar: self.notify(callback, lambda: onDone(cmdVar)))
+        except Exception as e:
+            visitContext.close()
+            callback(e)
+
+    def concludeVisit(self):
+        """Insert into visit_set, write pfsConfig if needed and release the visit."""
+        # Insert into visit_set in the database
+        self.sequence.engine.opdb.insertVisitSet('sps', sequence_id=self.sequence.sequence_id,
+                                                 pfs_visit_id=self.visitId)
+
+        # Write pfsConfig if required, should not happen but let's be careful.
+        if self.doWritePfsConfig:
+            self.writePfsConfig(self.pfsConfig)
+
+        # Release the visit as it is no longer active
+        self.release()
+
+    def callMcsExposureBefore(self, cmd, visit):
+        """Take MCS exposure prior to sps exposure, if configured."""
+        if self.mcsExposureBefore and self.mcsExposureBefore['enabled'] and self.sequence.isPfiExposure:
+            self.callMcsExposure(cmd, visit, **self.mcsExposureBefore)
 
     def callMcsExposure(self, cmd, visit, exptime, doFibreId, **kwargs):
         """Turn on/off illuminators and take MCS exposure."""
@@ -145,8 +186,13 @@ class SpsExpose(VisitedCmd):
         try:
             # Retrieve the reference visit (visit0) for comparison
             visit0 = self.visitManager.activeField.getVisit0()
+            # visit0 INSROT is cached when pfsConfig0 is loaded.
+            INSROT0 = self.sequence.engine.opdb.fetchVisit0INSROT(visit0)
+            # live telemetry first, opdb only if not available.
+            INSROT = self.iicActor.liveINSROT
+            INSROT = self.sequence.engine.opdb.fetchVisitINSROT(self.visitId) if INSROT is None else INSROT
             # Compute the delta INSROT between now and visit0.
-            dINSROT = self.sequence.engine.opdb.getDeltaINSROT(visit0, self.visitId)
+            dINSROT = INSROT - INSROT0
         except (ValueError, TypeError, exception.OpDBFailure):
             # Handle cases where INSROT calculation fails
             dINSROT = float(fitsMhs.INVALID)
@@ -179,7 +225,7 @@ class SpsExpose(VisitedCmd):
         if dINSROT not in {None, float(fitsMhs.INVALID)} and abs(dINSROT) > maxDeltaINSROT:
             pfsConfig.setInstrumentStatusFlag(InstrumentStatusFlag.INSROT_MISMATCH)
 
-        # Insert into opdb immediately
+        # Queued to the write-behind queue, nothing reads pfs_config_sps back.
         self.sequence.engine.opdb.insertPfsConfigSps(pfs_visit_id=pfsConfig.visit, visit0=pfsConfig.visit0,
                                                      camMask=pfsConfig.camMask, instStatusFlag=pfsConfig.instStatusFlag)
 
@@ -40,8 +40,9 @@ class SpsSequence(sequence.Sequence):
         return 'pfi' in self.allLightSources
 
     @property
-    def remainingExposures(self):
-        return [subCmd for subCmd in self.remainingCmds if isinstance(subCmd, SpsExpose)]
+    def nRemainingExposures(self):
+        self.remaining.sync()
+        return sum([count for cls, count in self.remaining.byType.items() if issubclass(cls, SpsExpose)])
 
     def initialize(self, engine, cmd):
         """
@@ -1,8 +1,14 @@
+import threading
+
 import ics.iicActor.utils.opdb as opdbUtils
+from ics.iicActor.utils import exception
 from ics.iicActor.utils import keyRepo
 from ics.iicActor.utils import registry
+from ics.iicActor.utils.executor import EngineExecutor
+from ics.iicActor.utils.journal import SequenceJournal
+from ics.iicActor.utils.latency import LatencyHistograms
+from ics.iicActor.utils.ledger import SubCmdLedger
 from ics.iicActor.utils.resources import resourceManager
-from ics.utils.threading import singleShot
 from ics.utils.visit import visitManager
 
 
@@ -29,26 +35,120 @@ class Engine(object):
         """
         self.actor = actor
 
+        # Bounded pool of worker threads, instead of one thread per command, also holds the engine config.
+        self.executor = EngineExecutor.fromConfig(actor)
+        # Admission is short but should not queue behind long synchronous sequences, it gets its own workers.
+        self.admission = EngineExecutor(actor, nWorkers=self.config.get('nAdmissionWorkers', 2),
+                                        maxQueued=self.executor.maxQueued, config=self.config, name='engineAdmission')
+
         # Initialize managers for resources, visits, registry, and key repository.
         self.resourceManager = resourceManager.ResourceManager(actor)
         self.visitManager = visitManager.VisitManager(actor)
         self.registry = registry.Registry(self)
         self.keyRepo = keyRepo.KeyRepo(self)
         self.opdb = opdbUtils.OpdbHandler(self)
+        # Drive sequences with non-blocking subcommand dispatch.
+        self.asynchronous = self.config.get('asynchronous', False)
+        # Wait up to resourceWait seconds for busy resources instead of rejecting right away, 0 means disabled.
+        self.resourceWait = self.config.get('resourceWait', 0)
+        # Crash-safe local record of sequences and subcommands, see `iic sequence resume`.
+        self.journal = SequenceJournal.fromConfig(self.config)
+        # Rolling window of phase durations per seqtype.
+        self.latency = LatencyHistograms(window=self.config.get('latencyWindow', 100))
+        # Local record of every subcommand round-trip.
+        self.ledger = SubCmdLedger.fromConfig(self.config)
+
+    @property
+    def config(self):
+        """Engine knobs from actorConfig['engine'], empty if not defined."""
+        return self.executor.config
 
-    @singleShot
-    def runInThread(self, *args, **kwargs):
+    def runInThread(self, cmd, sequence, **kwargs):
         """
-        Attach the run method to a QThread.
+        Submit sequence admission, the run method is then processed by the engine executor.
 
         Parameters
         ----------
-        *args, **kwargs :
-            Arguments to pass to the run method.
+        cmd : object
+            The command object initiating the sequence.
+        sequence : object
+            Sequence object to be processed.
+        **kwargs :
+            Keyword arguments to pass to the run method.
         """
-        return self.run(*args, **kwargs)
+        # Only complete sequences, with no custom commandLogic, can be processed asynchronously.
+        mode = kwargs.get('mode', ExecMode.FULLAUTO)
+        isAsync = self.asynchronous and mode == ExecMode.FULLAUTO and sequence.canRunAsync
+        run = self.runAsync if isAsync else self.run
 
-    def run(self, cmd, sequence, doFinish=True, mode=ExecMode.FULLAUTO):
+        try:
+            self.admission.submit(self.admit, run, cmd, sequence, **kwargs)
+        except exception.EngineQueueFull as e:
+            # command might have already been finished, in that case just warn.
+            if cmd is None:
+                self.actor.bcast.warn(f'text="{str(e)}"')
+            else:
+                cmd.fail(f'text="{str(e)}"')
+
+    def admit(self, run, cmd, sequence, **kwargs):
+        """
+        Lock sequence resources, then process run(cmd, sequence, locked=locked, **kwargs).
+
+        Parameters
+        ----------
+        run : callable
+            Either run or runAsync.
+        cmd : object
+            The command object initiating the sequence.
+        sequence : object
+            Sequence object to be processed.
+        **kwargs :
+            Keyword arguments to pass to the run method.
+
+        Notes
+        -----
+        - Busy resources are waited for by the resource manager waiter thread, so that no worker is held while waiting
+          in line, run is then submitted again once resources are granted.
+        """
+        sequence.attach(self, cmd)
+        phases = sequence.phases
+        phases.reset()
+
+        def onRejected(e):
+            phases.stop('request')
+            self.recordPhases(sequence)
+            sequence.getCmd().fail(f'text="{str(e)}"')
+
+        def onGranted(locked):
+            phases.stop('request')
+
+            try:
+                self.executor.submit(run, cmd, sequence, locked=locked, **kwargs)
+            except exception.EngineQueueFull as e:
+                self.resourceManager.free(locked)
+                onRejected(e)
+
+        try:
+            with phases.phase('inspect'):
+                resources = self.resourceManager.inspect(sequence)
+
+            phases.start('request')
+            locked = self.resourceManager.acquire(resources)
+
+        except exception.ResourceIsBusy as e:
+            if not self.resourceWait:
+                return onRejected(e)
+
+            self.resourceManager.enqueue(resources, self.resourceWait, onGranted, onRejected, cmd=sequence.getCmd())
+            return
+
+        except Exception as e:
+            return onRejected(e)
+
+        phases.stop('request')
+        run(cmd, sequence, locked=locked, **kwargs)
+
+    def run(self, cmd, sequence, doFinish=True, mode=ExecMode.FULLAUTO, locked=None):
         """
         Main engine function to manage command execution, resource allocation, and sequence flow.
 
@@ -62,47 +162,188 @@ class Engine(object):
             Whether to automatically finish the command after execution, by default True.
         mode : int, optional
             Execution mode flags determining the sequence flow, by default ExecMode.FULLAUTO.
+        locked : list, optional
+            Resources already locked by admit, if None resources are inspected and locked here.
 
         Notes
         -----
         - This method uses bitwise flags in mode to control sequence actions.
+        - Resources are inspected and locked prior to sequence initialization, so that busy resources are rejected
+          without any opdb access.
         """
-        locked = []  # Ensure locked is defined for resource cleanup
+        isLocked = locked is not None
+        locked = locked if isLocked else []  # Ensure locked is defined for resource cleanup
 
-        # Attach the command to the sequence by initializing it
-        sequence.initialize(self, cmd)
+        # Attach engine and command only, so that a rejection can be replied right away.
+        sequence.attach(self, cmd)
+        phases = sequence.phases
 
-        # Retrieve necessary resources based on the sequence requirements
-        resources = self.resourceManager.inspect(sequence)
+        # each run is timed on its own, unless resources have already been requested by admit.
+        if not isLocked:
+            phases.reset()
 
         try:
-            # Attempt to lock the required resources
-            locked = self.resourceManager.request(resources)
+            # Resource footprint is derived from the sequence definition alone, reject busy resources early.
+            if not isLocked:
+                with phases.phase('inspect'):
+                    resources = self.resourceManager.inspect(sequence)
+
+                with phases.phase('request'):
+                    locked = self.resourceManager.acquire(resources, timeout=self.resourceWait,
+                                                          cmd=sequence.getCmd())
+            # Shared with the sequence, which releases resources as soon as they are not needed anymore.
+            sequence.lockedResources = locked
+
+            # Resources are held, database and keyword work can be done now.
+            with phases.phase('initialize'):
+                sequence.initialize(self, cmd)
 
             # Check if CHECKIN flag is set
             if mode & ExecMode.CHECKIN:
-                sequence.startup()  # Run startup routine for the sequence
+                with phases.phase('startup'):
+                    sequence.startup()  # Run startup routine for the sequence
                 self.registry.register(sequence)  # Store sequence in the registry
 
             # Check if EXECUTE flag is set
             if mode & ExecMode.EXECUTE:
                 try:
-                    sequence.commandLogic()  # Perform main command logic
+                    with phases.phase('commandLogic'):
+                        sequence.commandLogic()  # Perform main command logic
                 finally:
                     # Check if CONCLUDE flag is set
                     if mode & ExecMode.CONCLUDE:
-                        sequence.finalize()
+                        with phases.phase('finalize'):
+                            sequence.finalize()
+
+        except Exception as e:
+            sequence.getCmd().fail(f'text="{str(e)}"')
+            return
+
+        finally:
+            with phases.phase('free'):
+                self.resourceManager.free(locked)
+
+            self.recordPhases(sequence)
+
+        if doFinish:
+            sequence.thisIsTheEnd()
+
+    def runAsync(self, cmd, sequence, doFinish=True, mode=ExecMode.FULLAUTO, locked=None):
+        """
+        Non-blocking counterpart of run, the calling thread is released once the sequence has started.
+
+        Parameters
+        ----------
+        cmd : object
+            The command object initiating the sequence.
+        sequence : object
+            Sequence object containing initialization, command logic, and finalization.
+        doFinish : bool, optional
+            Whether to automatically finish the command after execution, by default True.
+        mode : int, optional
+            Only ExecMode.FULLAUTO is supported.
+        locked : list, optional
+            Resources already locked by admit, if None resources are inspected and locked here.
+
+        Notes
+        -----
+        - Subcommands are dispatched through cmdr.bgCall, so that no thread is held while they are running.
+        - Replies, finalize and resource release are processed by the engine executor as continuations, the reactor
+          thread only receives replies.
+        """
+        if mode != ExecMode.FULLAUTO:
+            raise ValueError('only FULLAUTO mode can be processed asynchronously')
+
+        isLocked = locked is not None
+        locked = locked if isLocked else []
+
+        sequence.attach(self, cmd)
+        phases = sequence.phases
+
+        if not isLocked:
+            phases.reset()
+
+        try:
+            if not isLocked:
+                with phases.phase('inspect'):
+                    resources = self.resourceManager.inspect(sequence)
+
+                with phases.phase('request'):
+                    locked = self.resourceManager.acquire(resources, timeout=self.resourceWait,
+                                                          cmd=sequence.getCmd())
+            sequence.lockedResources = locked
+
+            with phases.phase('initialize'):
+                sequence.initialize(self, cmd)
+
+            with phases.phase('startup'):
+                sequence.startup()
+            self.registry.register(sequence)
+
+        except Exception as e:
+            with phases.phase('free'):
+                self.resourceManager.free(locked)
+
+            self.recordPhases(sequence)
+            sequence.getCmd().fail(f'text="{str(e)}"')
+            return
+
+        # never released, so that the sequence is concluded only once.
+        concluded = threading.Lock()
+
+        def onConcluded(failure):
+            """Finalize in the executor, only once."""
+            if not concluded.acquire(blocking=False):
+                return
+
+            phases.stop('commandLogic')
+
+            # resources must be released no matter what, continuations are never refused.
+            self.executor.resume(self.conclude, sequence, locked, failure, doFinish)
+
+        phases.start('commandLogic')
+
+        try:
+            sequence.commandLogicAsync(onConcluded)
+        except Exception as e:
+            # resources must be released no matter what.
+            onConcluded(e)
+
+    def conclude(self, sequence, locked, failure=None, doFinish=True):
+        """Finalize an asynchronous sequence, free resources and finish the command."""
+        phases = sequence.phases
+
+        try:
+            with phases.phase('finalize'):
+                sequence.finalize()
+
+            if failure is not None:
+                raise failure
 
         except Exception as e:
             sequence.getCmd().fail(f'text="{str(e)}"')
             return
 
         finally:
-            self.resourceManager.free(locked)
+            with phases.phase('free'):
+                self.resourceManager.free(locked)
+
+            self.recordPhases(sequence)
 
         if doFinish:
             sequence.thisIsTheEnd()
 
+    def recordPhases(self, sequence):
+        """Add sequence phase durations to the rolling histograms and publish them, only count rejected sequences."""
+        # inspect/request only samples would skew the histograms, and there is no sequence_id to publish.
+        if sequence.sequence_id is None:
+            self.latency.reject(sequence)
+            return
+
+        self.latency.record(sequence)
+        # command might already be finished, broadcast instead.
+        sequence.genPhaseKeys(self.actor.bcast)
+
     def requestGroupId(self, groupName, doContinue=False):
         """
         Request or create a sequence group ID based on the provided group name.
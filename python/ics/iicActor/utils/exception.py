@@ -20,6 +20,10 @@ class ResourceIsBusy(IicException):
     """Exception raised when exposure is just trash and needs to be cleared ASAP."""
 
 
+class EngineQueueFull(IicException):
+    """Exception raised when the engine submission queue cannot accept any more task."""
+
+
 class OpDBFailure(IicException):
     """Exception raised when exposure is just trash and needs to be cleared ASAP."""
 
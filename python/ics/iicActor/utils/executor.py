@@ -0,0 +1,158 @@
+import collections
+import logging
+import threading
+
+import ics.utils.time as pfsTime
+from ics.iicActor.utils import exception
+
+
+class Task(object):
+    """Placeholder for a job submitted to the engine executor."""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.submittedAt = pfsTime.timestamp()
+        self.startedAt = None
+
+    @property
+    def waitTime(self):
+        """Time spent in the submission queue, in seconds."""
+        startedAt = pfsTime.timestamp() if self.startedAt is None else self.startedAt
+        return startedAt - self.submittedAt
+
+    def run(self):
+        """Mark task as started and process it."""
+        self.startedAt = pfsTime.timestamp()
+        return self.func(*self.args, **self.kwargs)
+
+
+class EngineExecutor(object):
+    """Fixed pool of worker threads fed by a bounded submission queue, continuations of admitted work go first.
+
+    Synchronous sequences hold a worker from start to end, which can be hours, so nWorkers bounds how many of them can
+    run at once. Short tasks which should not queue behind them, admission mostly, go through their own executor.
+    """
+
+    def __init__(self, actor, nWorkers=16, maxQueued=64, config=None, name='engineExecutor', congestedDepth=None,
+                 congestedWait=5):
+        self.actor = actor
+        self.config = dict() if config is None else config
+        self.name = name
+        self.logger = logging.getLogger(name)
+
+        self.nWorkers = int(nWorkers)
+        self.maxQueued = int(maxQueued)
+        # above either threshold, the keyword is generated right away, and again once back to normal.
+        self.congestedDepth = self.maxQueued // 2 if congestedDepth is None else int(congestedDepth)
+        self.congestedWait = float(congestedWait)
+
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.continuations = collections.deque()
+        self.lock = threading.Lock()
+
+        self.nActive = 0
+        self.isCongested = False
+        # wait time statistics since the last report.
+        self.nTasks = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+        self.workers = []
+        for iWorker in range(self.nWorkers):
+            worker = threading.Thread(target=self.work, name=f'{name}{iWorker:02d}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __str__(self):
+        meanWait = self.totalWait / self.nTasks if self.nTasks else 0
+        return f'{self.name}={self.nWorkers},{self.nActive},{self.nQueued},{self.maxQueued},' \
+               f'{self.nTasks},{meanWait:.3f},{self.maxWait:.3f}'
+
+    @property
+    def nQueued(self):
+        """Number of tasks waiting for a worker."""
+        return len(self.pending) + len(self.continuations)
+
+    @classmethod
+    def fromConfig(cls, actor):
+        """Instantiate executor from actorConfig['engine'], falling back on defaults."""
+        try:
+            config = actor.actorConfig.get('engine', dict())
+        except AttributeError:
+            config = dict()
+
+        knobs = dict([(key, config[key]) for key in ['nWorkers', 'maxQueued', 'congestedDepth', 'congestedWait']
+                      if key in config])
+        return cls(actor, config=config, **knobs)
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to be processed by the next available worker, refused if the queue is full."""
+        task = Task(func, args, kwargs)
+
+        with self.condition:
+            if self.nQueued >= self.maxQueued:
+                raise exception.EngineQueueFull(f'{self.nQueued} tasks already queued.')
+
+            self.pending.append(task)
+            self.condition.notify()
+
+        return task
+
+    def resume(self, func, *args, **kwargs):
+        """Queue the continuation of work which is already running, never refused but processed ahead of new tasks.
+
+        Replies are received by the reactor thread, which should never do the work itself. New tasks are refused
+        until the queue is back under maxQueued, which is how backpressure is applied.
+        """
+        task = Task(func, args, kwargs)
+
+        with self.condition:
+            self.continuations.append(task)
+            self.condition.notify()
+
+        return task
+
+    def work(self):
+        """Worker loop, process tasks forever."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.nQueued)
+                task = (self.continuations or self.pending).popleft()
+
+            waitTime = task.waitTime
+
+            with self.lock:
+                self.nActive += 1
+                self.nTasks += 1
+                self.totalWait += waitTime
+                self.maxWait = max(self.maxWait, waitTime)
+
+                isCongested = self.nQueued >= self.congestedDepth or waitTime >= self.congestedWait
+                doReport = isCongested != self.isCongested
+                self.isCongested = isCongested
+
+            if doReport:
+                self.genKeys()
+
+            try:
+                task.run()
+            except Exception:
+                self.logger.exception(f'uncaught exception while running {task.func.__name__}')
+            finally:
+                with self.lock:
+                    self.nActive -= 1
+
+    def genKeys(self, cmd=None):
+        """Generate executor keyword and reset wait time statistics."""
+        cmd = self.actor.bcast if cmd is None else cmd
+
+        with self.lock:
+            keyword = str(self)
+            self.nTasks = 0
+            self.totalWait = 0.0
+            self.maxWait = 0.0
+
+        cmd.inform(keyword)
@@ -0,0 +1,96 @@
+import logging
+
+from ics.iicActor.utils.jsonLines import JsonLines, localPath
+
+
+class SequenceJournal(object):
+    """Local append-only journal of sequence definitions and subcommand completion, survives actor restarts."""
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger('sequenceJournal')
+        self.file = JsonLines(path, logger=self.logger)
+        # sequences journaled in that session.
+        self.journaled = set()
+
+        # only keep sequences that never reached the end.
+        self.compact()
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Journal at config['journalPath'], ~/.iic/sequenceJournal.jsonl by default."""
+        return cls(localPath(config, 'journalPath', 'sequenceJournal.jsonl'))
+
+    def write(self, **record):
+        """Append a record and flush it right away."""
+        self.file.append(record)
+
+    def read(self):
+        """Return all records, skipping truncated lines."""
+        return self.file.read()
+
+    def compact(self):
+        """Rewrite the journal keeping only unfinished sequences."""
+        records = self.read()
+        finished = set([record['sequence_id'] for record in records if record['event'] == 'end'])
+        self.file.rewrite([record for record in records if record['sequence_id'] not in finished])
+
+    def start(self, sequence):
+        """Record sequence definition, only for sequences which can be rebuilt from their original command."""
+        # the resumed sequence is taken over from now on, it cannot be resumed again.
+        if sequence.resumedFrom is not None:
+            self.resumed(sequence.resumedFrom)
+
+        if sequence.cmdKeys is None or not sequence.isResumable:
+            return
+
+        cls = type(sequence)
+        self.journaled.add(sequence.sequence_id)
+        self.write(event='start', sequence_id=sequence.sequence_id, module=cls.__module__, className=cls.__name__,
+                   rawCmd=sequence.rawCmd, cmdStr=sequence.cmdStr, seqtype=sequence.seqtype)
+
+        # already successful subcommands, if that sequence is itself a resumed one.
+        for subCmd in sequence.subCmds:
+            if subCmd.cmdRet.succeed:
+                self.update(subCmd)
+
+    def update(self, subCmd):
+        """Record subcommand completion."""
+        if subCmd.sequence.sequence_id not in self.journaled:
+            return
+
+        self.write(event='subCmd', sequence_id=subCmd.sequence.sequence_id, id=subCmd.id,
+                   status=subCmd.cmdRet.status)
+
+    def end(self, sequence):
+        """Record sequence conclusion."""
+        if sequence.sequence_id not in self.journaled:
+            return
+
+        self.journaled.discard(sequence.sequence_id)
+        self.write(event='end', sequence_id=sequence.sequence_id, status=str(sequence.status.current))
+
+    def resumed(self, sequenceId):
+        """Record that a sequence has been resumed, so that it cannot be resumed twice."""
+        self.write(event='end', sequence_id=sequenceId, status='resumed')
+
+    def lookup(self, sequenceId):
+        """Return sequence definition and ids of successful subcommands."""
+        definition = None
+        succeeded = set()
+
+        for record in self.read():
+            if record['sequence_id'] != sequenceId:
+                continue
+
+            if record['event'] == 'start':
+                definition = record
+            elif record['event'] == 'subCmd' and record['status'] == 0:
+                succeeded.add(record['id'])
+            elif record['event'] == 'end':
+                raise KeyError(f'sequence {sequenceId} is already {record["status"]}')
+
+        if definition is None:
+            raise KeyError(f'sequence {sequenceId} is not in the journal')
+
+        return definition, succeeded
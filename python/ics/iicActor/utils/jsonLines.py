@@ -0,0 +1,86 @@
+import datetime
+import json
+import logging
+import os
+import threading
+
+
+def localPath(config, key, fileName):
+    """Return config[key] if defined, ~/.iic/fileName otherwise."""
+    return config.get(key, os.path.join(os.path.expanduser('~'), '.iic', fileName))
+
+
+def makeDirs(path):
+    """Create parent directory of path if needed."""
+    dirName = os.path.dirname(path)
+
+    if dirName:
+        os.makedirs(dirName, exist_ok=True)
+
+
+def encode(value):
+    """Make datetime json serializable."""
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+
+    raise TypeError(f'{type(value).__name__} is not serializable')
+
+
+def decode(obj):
+    """Restore datetime from json."""
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+
+    return obj
+
+
+class JsonLines(object):
+    """Local append-only json-lines file, every record is flushed right away so it survives actor restarts."""
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logging.getLogger('jsonLines') if logger is None else logger
+        self.lock = threading.Lock()
+
+        makeDirs(self.path)
+
+    def append(self, record):
+        """Append a record and flush it right away."""
+        line = json.dumps(record, default=encode)
+
+        with self.lock:
+            try:
+                with open(self.path, 'a') as file:
+                    file.write(f'{line}\n')
+                    file.flush()
+            except OSError as e:
+                self.logger.warning(f'could not write to {self.path}: {e}')
+
+    def read(self):
+        """Return all records, skipping truncated lines."""
+        records = []
+
+        if not os.path.isfile(self.path):
+            return records
+
+        with self.lock:
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line, object_hook=decode))
+                    except ValueError:
+                        continue
+
+        return records
+
+    def rewrite(self, records):
+        """Replace the whole file with records, through a temporary file so it is never left half written."""
+        tmpPath = f'{self.path}.tmp'
+
+        with self.lock:
+            try:
+                with open(tmpPath, 'w') as file:
+                    file.writelines([f'{json.dumps(record, default=encode)}\n' for record in records])
+                os.replace(tmpPath, self.path)
+            except OSError as e:
+                self.logger.warning(f'could not compact {self.path}: {e}')
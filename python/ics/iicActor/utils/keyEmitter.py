@@ -0,0 +1,116 @@
+import threading
+import time
+import weakref
+
+import ics.utils.time as pfsTime
+from opscore.utility.qstr import qstr
+
+
+class KeyEmitter(object):
+    """Generate sequence and subcommand keywords, batching declarations and coalescing duplicates.
+
+    In compact mode, subcommands are declared in chunks through the subCommands keyword, and further updates are
+    generated as id-based subCommandStatus deltas, otherwise the legacy subCommand keyword is used for both.
+    """
+    maxBytes = 1024
+
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.lock = threading.Lock()
+
+        self.nLines = 0
+        self.nBytes = 0
+        # last line sent per command and key, command ids can be recycled so key by the command object itself.
+        self.lastSent = weakref.WeakKeyDictionary()
+        self.declared = dict()
+        self.lastChunkAt = 0
+
+    @property
+    def config(self):
+        """Engine knobs, empty if the sequence is not attached yet."""
+        return dict() if self.sequence.engine is None else self.sequence.engine.config
+
+    @property
+    def compact(self):
+        return self.config.get('compactKeys', False)
+
+    def __str__(self):
+        return f'sequenceKeys={self.sequence.sequence_id},{self.nLines},{self.nBytes}'
+
+    def send(self, cmd, line, warn=False, key=None):
+        """Generate a keyword line, skip it if key is provided and the very same line was just sent to cmd."""
+        with self.lock:
+            if key is not None:
+                lastSent = self.lastSent.setdefault(cmd, dict())
+
+                if lastSent.get(key) == line:
+                    return
+
+                lastSent[key] = line
+
+            self.nLines += 1
+            self.nBytes += len(line)
+
+        genKeys = cmd.warn if warn else cmd.inform
+        genKeys(line)
+
+    def declare(self, cmd, subCmds):
+        """Declare subcommands to come."""
+        if not self.compact:
+            for subCmd in subCmds:
+                self.send(cmd, str(subCmd), warn=subCmd.cmdRet.didFail)
+            return
+
+        for chunk in self.chunked(subCmds):
+            self.sendChunk(cmd, chunk)
+
+    def chunked(self, subCmds):
+        """Split subcommands into chunks of consecutive ids that fit in maxBytes."""
+        maxBytes = self.config.get('maxKeyBytes', KeyEmitter.maxBytes)
+        chunks = []
+        nBytes = 0
+
+        for subCmd in subCmds:
+            size = len(qstr(subCmd.fullCmd)) + 1
+            isConsecutive = chunks and chunks[-1][-1].id + 1 == subCmd.id
+
+            if isConsecutive and nBytes + size <= maxBytes:
+                chunks[-1].append(subCmd)
+                nBytes += size
+            else:
+                chunks.append([subCmd])
+                nBytes = size
+
+        return chunks
+
+    def sendChunk(self, cmd, chunk):
+        """Generate subCommands keyword for a chunk of consecutive subcommands, rate-limited if configured."""
+        minDelay = self.config.get('keyChunkDelay', 0)
+        wait = self.lastChunkAt + minDelay - pfsTime.timestamp()
+
+        if wait > 0:
+            time.sleep(wait)
+
+        self.lastChunkAt = pfsTime.timestamp()
+
+        for subCmd in chunk:
+            self.declared[subCmd.id] = subCmd.fullCmd
+
+        fullCmds = ','.join([qstr(subCmd.fullCmd) for subCmd in chunk])
+        self.send(cmd, f'subCommands={self.sequence.sequence_id},{chunk[0].id},{fullCmds}')
+
+    def update(self, cmd, subCmd):
+        """Generate subcommand status update."""
+        if not self.compact:
+            return self.send(cmd, str(subCmd), warn=subCmd.cmdRet.didFail)
+
+        # fullCmd has changed (visit, metadata...), declare it again.
+        if self.declared.get(subCmd.id) != subCmd.fullCmd:
+            self.sendChunk(cmd, [subCmd])
+
+        self.send(cmd, f'subCommandStatus={self.sequence.sequence_id},{subCmd.id},{subCmd.cmdRet}',
+                  warn=subCmd.cmdRet.didFail, key=f'subCommand{subCmd.id}')
+
+    def genKeys(self, cmd):
+        """Generate sequenceKeys keyword."""
+        cmd.inform(str(self))
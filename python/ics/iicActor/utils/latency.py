@@ -0,0 +1,118 @@
+import collections
+import contextlib
+import threading
+import time
+
+
+class PhaseTimer(object):
+    """Monotonic timestamps for each engine phase of a sequence."""
+    phases = ['inspect', 'request', 'initialize', 'startup', 'commandLogic', 'finalize', 'free']
+
+    def __init__(self):
+        self.timestamps = dict()
+
+    def reset(self):
+        """Forget everything, a sequence can go through the engine several times (CHECKIN, EXECUTE...)."""
+        self.timestamps = dict()
+
+    def start(self, phase):
+        self.timestamps[phase] = (time.monotonic(), None)
+
+    def stop(self, phase):
+        if phase not in self.timestamps:
+            return
+
+        startedAt, __ = self.timestamps[phase]
+        self.timestamps[phase] = (startedAt, time.monotonic())
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """Time the enclosed block, even if it raises."""
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop(phase)
+
+    @property
+    def durations(self):
+        """Duration of each completed phase, in seconds, in engine order."""
+        durations = []
+
+        for phase in PhaseTimer.phases:
+            startedAt, endedAt = self.timestamps.get(phase, (None, None))
+            if endedAt is not None:
+                durations.append((phase, endedAt - startedAt))
+
+        return durations
+
+    @property
+    def deadTime(self):
+        """Time spent outside of any phase, between the first and the last timestamp."""
+        timestamps = [ts for ts in self.timestamps.values() if ts[1] is not None]
+
+        if not timestamps:
+            return 0
+
+        total = max([endedAt for __, endedAt in timestamps]) - min([startedAt for startedAt, __ in timestamps])
+        return total - sum([duration for __, duration in self.durations])
+
+
+class LatencyHistograms(object):
+    """Rolling window of phase durations for each seqtype."""
+
+    def __init__(self, window=100):
+        self.window = int(window)
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+        # sequences rejected before they started, kept out of the samples.
+        self.nRejected = collections.Counter()
+
+    @staticmethod
+    def percentile(values, q):
+        """Nearest-rank percentile of values, q in [0, 100]."""
+        values = sorted(values)
+        index = int(round(q / 100 * (len(values) - 1)))
+        return values[index]
+
+    def record(self, sequence):
+        """Add sequence phase durations to its seqtype window."""
+        with self.lock:
+            for phase, duration in sequence.phases.durations:
+                self.samples[(sequence.seqtype, phase)].append(duration)
+
+    def reject(self, sequence):
+        """Count a sequence which has been rejected before it started."""
+        with self.lock:
+            self.nRejected[sequence.seqtype] += 1
+
+    def summary(self, seqtype=None):
+        """Return (seqtype, phase, n, p50, p90, max) for each recorded phase, optionally only for seqtype."""
+        with self.lock:
+            samples = dict([(key, list(values)) for key, values in self.samples.items()])
+
+        rows = []
+        for (thisType, phase), values in sorted(samples.items()):
+            if seqtype is not None and thisType != seqtype:
+                continue
+
+            rows.append((thisType, phase, len(values), LatencyHistograms.percentile(values, 50),
+                         LatencyHistograms.percentile(values, 90), max(values)))
+
+        return rows
+
+    def genKeys(self, cmd, seqtype=None):
+        """Generate one phaseLatency keyword per seqtype and phase."""
+        rows = self.summary(seqtype=seqtype)
+
+        for thisType, phase, nSamples, p50, p90, maxDuration in rows:
+            cmd.inform(f'phaseLatency={thisType},{phase},{nSamples},{p50:.3f},{p90:.3f},{maxDuration:.3f}')
+
+        with self.lock:
+            nRejected = sorted(self.nRejected.items())
+
+        for thisType, nSequences in nRejected:
+            if seqtype is None or thisType == seqtype:
+                cmd.inform(f'phaseRejected={thisType},{nSequences}')
+
+        return len(rows)
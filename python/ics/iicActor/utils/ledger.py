@@ -0,0 +1,170 @@
+import collections
+import csv
+import logging
+import os
+import threading
+
+import ics.utils.cmd as cmdUtils
+from ics.iicActor.utils.jsonLines import localPath, makeDirs
+from ics.iicActor.utils.latency import LatencyHistograms
+from ics.iicActor.utils.lib import stripQuotes
+
+
+class SubCmdLedger(object):
+    """Append-only csv ledger of subcommand round-trips, one row per call, rotated every maxRows rows."""
+    columns = ['dispatchedAt', 'firstReplyAt', 'completedAt', 'actor', 'cmdHead', 'args', 'timeLim', 'status',
+               'nReplies', 'duration']
+
+    def __init__(self, path, window=50, maxRows=10000):
+        self.path = path
+        self.logger = logging.getLogger('subCmdLedger')
+        self.lock = threading.Lock()
+        self.window = int(window)
+        self.maxRows = int(maxRows)
+
+        makeDirs(self.path)
+
+        # the file is only read once, queries are served from the most recent rows kept in memory.
+        previous = self.readRows(f'{self.path}.1')
+        current = self.readRows(self.path)
+        self.nRows = len(current)
+        self.rows = collections.deque(previous + current, maxlen=self.maxRows)
+
+        # recent successful durations per actor, cmdHead and arguments.
+        self.history = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+        for row in self.rows:
+            self.addToHistory(row)
+
+        if not os.path.isfile(self.path):
+            self.writeRow(SubCmdLedger.columns)
+        elif self.readHeader() != SubCmdLedger.columns:
+            # columns changed, do not append to a file that would not parse anymore.
+            self.rotate()
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Ledger at config['ledgerPath'], ~/.iic/subCmdLedger.csv by default."""
+        return cls(localPath(config, 'ledgerPath', 'subCmdLedger.csv'), window=config.get('timeLimWindow', 50),
+                   maxRows=config.get('ledgerMaxRows', 10000))
+
+    @staticmethod
+    def identify(subCmd):
+        """Key under which similar calls are grouped."""
+        return subCmd.actor, subCmd.cmdHead, SubCmdLedger.arguments(subCmd)
+
+    @staticmethod
+    def arguments(subCmd):
+        """Command arguments without head and visit, so that calls can be grouped together."""
+        args = cmdUtils.stripCmdKey(subCmd.cmdStr, 'visit')
+        return stripQuotes(args[len(subCmd.cmdHead):])
+
+    def readRows(self, path):
+        """Return all rows of a ledger file as dictionaries, empty if it does not exist."""
+        if not os.path.isfile(path):
+            return []
+
+        try:
+            with open(path, 'r', newline='') as ledger:
+                return [dict([(key, row[key]) for key in SubCmdLedger.columns]) for row in csv.DictReader(ledger)]
+        except (OSError, KeyError, csv.Error) as e:
+            self.logger.warning(f'could not read {path}: {e}')
+            return []
+
+    def readHeader(self):
+        """Return the current ledger header."""
+        try:
+            with open(self.path, 'r', newline='') as ledger:
+                return next(csv.reader(ledger), [])
+        except (OSError, csv.Error):
+            return []
+
+    def writeRow(self, row):
+        """Append a single row and flush it right away."""
+        try:
+            with open(self.path, 'a', newline='') as ledger:
+                csv.writer(ledger).writerow(row)
+        except OSError as e:
+            self.logger.warning(f'could not write to {self.path}: {e}')
+
+    def rotate(self):
+        """Move the ledger to path.1, replacing the previous one, and start a new one."""
+        try:
+            os.replace(self.path, f'{self.path}.1')
+        except OSError as e:
+            self.logger.warning(f'could not rotate {self.path}: {e}')
+
+        self.writeRow(SubCmdLedger.columns)
+        self.nRows = 0
+
+    def addToHistory(self, row):
+        """Keep track of successful durations."""
+        if row['status'] == '0':
+            self.history[(row['actor'], row['cmdHead'], row['args'])].append(float(row['duration']))
+
+    def record(self, subCmd, nReplies):
+        """Add subcommand round-trip, with the timeLim it was actually sent with."""
+        dispatchedAt, firstReplyAt, completedAt = subCmd.timestamps
+        actor, cmdHead, args = SubCmdLedger.identify(subCmd)
+
+        values = [f'{dispatchedAt:.3f}', f'{firstReplyAt:.3f}', f'{completedAt:.3f}', actor, cmdHead, args,
+                  str(subCmd.sentTimeLim), str(subCmd.cmdRet.status), str(nReplies),
+                  f'{completedAt - dispatchedAt:.3f}']
+
+        with self.lock:
+            if self.nRows >= self.maxRows:
+                self.rotate()
+
+            self.writeRow(values)
+            self.nRows += 1
+
+            row = dict(zip(SubCmdLedger.columns, values))
+            self.rows.append(row)
+            self.addToHistory(row)
+
+    def estimate(self, subCmd, factor=1.5, minSamples=5, floor=10):
+        """Return timeLim from the slowest recent similar calls times a safety factor, None if not enough history."""
+        with self.lock:
+            durations = list(self.history.get(SubCmdLedger.identify(subCmd), []))
+
+        if len(durations) < minSamples:
+            return None
+
+        return max(floor, round(factor * max(durations)))
+
+    def load(self, actor=None, cmdHead=None):
+        """Return most recent rows as dictionaries, optionally filtered by actor and cmdHead."""
+        with self.lock:
+            rows = list(self.rows)
+
+        if actor is not None:
+            rows = [row for row in rows if row['actor'] == actor]
+        if cmdHead is not None:
+            rows = [row for row in rows if row['cmdHead'] == cmdHead]
+
+        return rows
+
+    def summary(self, actor=None, cmdHead=None):
+        """Return duration percentiles and worst duration/timeLim ratio for each actor, cmdHead and arguments."""
+        groups = collections.defaultdict(list)
+
+        for row in self.load(actor=actor, cmdHead=cmdHead):
+            groups[(row['actor'], row['cmdHead'], row['args'])].append(row)
+
+        summary = []
+        for (thisActor, thisHead, args), rows in sorted(groups.items()):
+            durations = [float(row['duration']) for row in rows]
+            p50, p90, p99 = [LatencyHistograms.percentile(durations, q) for q in [50, 90, 99]]
+            ratio = max([float(row['duration']) / float(row['timeLim']) for row in rows])
+            summary.append((thisActor, thisHead, args, len(rows), p50, p90, p99, max(durations), ratio))
+
+        return summary
+
+    def genKeys(self, cmd, actor=None, cmdHead=None):
+        """Generate one subCmdLatency keyword per actor, cmdHead and arguments."""
+        rows = self.summary(actor=actor, cmdHead=cmdHead)
+
+        for thisActor, thisHead, args, nCalls, p50, p90, p99, maxDuration, ratio in rows:
+            cmd.inform(f'subCmdLatency={thisActor},{thisHead},"{args}",{nCalls},{p50:.3f},{p90:.3f},{p99:.3f},'
+                       f'{maxDuration:.3f},{ratio:.3f}')
+
+        return len(rows)
@@ -1,50 +1,108 @@
+import datetime
 import logging
-import time
+import threading
 
 import ics.iicActor.utils.lib as iicUtils
 import pandas as pd
 import pfs.utils.ingestPfsDesign as ingestPfsDesign
+import sqlalchemy
 from ics.iicActor.utils import exception
-from ics.iicActor.utils.sequenceStatus import Flag
-from pfs.utils.database import opdb
+from ics.iicActor.utils.opdbPool import OpdbPool
+from ics.iicActor.utils.queries import QueryCatalog
+from ics.iicActor.utils.ttlCache import TtlCache
+from ics.iicActor.utils.writeBehind import WriteBehindQueue
 
 
 class OpdbHandler:
     def __init__(self, engine):
         self.engine = engine
-        self.opdb = opdb.OpDB()
+        # single engine shared by all threads, connections are checked out per statement.
+        self.pool = OpdbPool.fromConfig(engine.config)
+        # named statements, prepared once per connection.
+        self.queries = QueryCatalog(prepare=engine.config.get('opdbPrepare', True))
+        # group names never change, last group ids only change when a group is created.
+        self.groupNames = TtlCache(ttl=engine.config.get('groupNameTtl', 3600))
+        self.lastGroupIds = TtlCache(ttl=engine.config.get('lastGroupIdTtl', 60))
+        # INSROT at convergence, one per field.
+        self.visit0INSROT = TtlCache(ttl=engine.config.get('visit0INSROTTtl', 86400))
+        # pfsDesignIds known to be in opdb, designs are never removed so that index only grows.
+        self.knownDesignIds = set()
+        # serialize id allocation within the actor, concurrent writers are handled by allocate().
+        self.allocationLock = threading.Lock()
+        # non-critical inserts can be written in the background, only if enabled.
+        self.writeBehind = WriteBehindQueue.fromConfig(self, engine.config) if engine.config.get('writeBehind',
+                                                                                                  False) else None
+
+        # designs are otherwise checked one by one as they come, prefetching every id is opt-in.
+        if engine.config.get('prefetchDesignIds', False):
+            try:
+                engine.executor.submit(self.prefetchDesignIds)
+            except exception.EngineQueueFull as e:
+                logging.warning(f'could not prefetch pfsDesignIds: {e}')
+
+    def run(self, name, **params):
+        """Run a catalog statement in its own transaction and return (columns, rows), only reads are retried."""
+        return self.pool.run(lambda connection: self.queries.run(connection, name, **params),
+                             retry=self.queries[name].isReadOnly)
 
-    def fetch(self, sql):
-        """Return full DataFrame result of a query."""
+    def query(self, name, **params):
+        """Return full DataFrame result of a catalog query."""
         try:
-            return self.opdb.query_dataframe(sql)
+            columns, rows = self.run(name, **params)
         except Exception as e:
             raise exception.OpDBFailure(iicUtils.stripQuotes(str(e)))
 
-    def fetchone(self, sql):
-        """Return a single scalar value from a query (squeeze DataFrame)."""
-        return self.fetch(sql).squeeze()
+        return pd.DataFrame(rows, columns=columns)
+
+    def queryone(self, name, **params):
+        """Return a single scalar value from a catalog query (squeeze DataFrame)."""
+        return self.query(name, **params).squeeze()
+
+    def allocate(self, name, table, maxAttempts=5, **kwargs):
+        """Run an insert allocating id=max(id)+1 in a single statement and return the new id, retry on collision."""
+        with self.allocationLock:
+            for attempt in range(maxAttempts):
+                try:
+                    __, [(newId,)] = self.run(name, **kwargs)
+                    return int(newId)
+                # another writer got that id first, just try again.
+                except sqlalchemy.exc.IntegrityError as e:
+                    reason = e
+                except Exception as e:
+                    raise exception.OpdbInsertFailed(table, e)
 
-    def fetchLastSequenceId(self):
-        """Get last sequence_id FROM iic_sequence table."""
-        sequence_id = self.fetchone('SELECT max(iic_sequence_id) FROM iic_sequence')
-        sequence_id = 0 if sequence_id is None else sequence_id
-        return int(sequence_id)
+        raise exception.OpdbInsertFailed(table, reason)
+
+    def defer(self, method, **kwargs):
+        """Queue self.method(**kwargs) to the write-behind queue, or call it right away and return its output."""
+        if self.writeBehind is None:
+            return getattr(self, method)(**kwargs)
+
+        self.writeBehind.submit(method, **kwargs)
 
     def fetchLastGroupId(self):
         """Get last group_id FROM sequence_group table."""
-        group_id = self.fetchone('SELECT max(group_id) FROM sequence_group')
-        group_id = 0 if group_id is None else group_id
-        return int(group_id)
+
+        def load():
+            group_id = self.queryone('lastGroupId')
+            group_id = 0 if group_id is None else group_id
+            return int(group_id)
+
+        # None stands for any group_name.
+        return self.lastGroupIds.get(None, load)
 
     def fetchLastGroupIdMatchingName(self, group_name):
         """Get last group_id FROM sequence_group table matching group_name."""
-        group_id = self.fetchone(f"SELECT max(group_id) FROM sequence_group WHERE group_name='{group_name}'")
-        # something went wrong here
-        if not group_id:
-            raise exception.OpDBFailure(f'no sequence_group match group_name: {group_name}')
 
-        return int(group_id)
+        def load():
+            group_id = self.queryone('lastGroupIdMatchingName', group_name=str(group_name))
+            # something went wrong here
+            if not group_id:
+                raise exception.OpDBFailure(f'no sequence_group match group_name: {group_name}')
+
+            return int(group_id)
+
+        return self.lastGroupIds.get(str(group_name), load)
 
     def getGroupNameFromGroupId(self, group_id):
         """
@@ -65,70 +123,76 @@ class OpdbHandler:
         exception.OpDBFailure
             If no matching group_name is found for the given group_id.
         """
-        group_name = self.fetchone(f"SELECT group_name FROM sequence_group WHERE group_id={int(group_id)}")
 
-        if not group_name:
-            raise exception.OpDBFailure(f'No group_name found for group_id: {group_id}')
+        def load():
+            group_name = self.queryone('groupNameFromGroupId', group_id=int(group_id))
 
-        return str(group_name)
+            if not group_name:
+                raise exception.OpDBFailure(f'No group_name found for group_id: {group_id}')
 
-    def getDeltaINSROT(self, visit0, spsVisitId):
-        """Compute the difference in INSROT (instrument rotation) between spsVisit and visit0."""
-        INSROT0 = self.fetchone(
-            f"SELECT insrot FROM tel_status WHERE pfs_visit_id={visit0} and caller='mcs' ORDER BY status_sequence_id DESC LIMIT 1")
-        INSROT = self.fetchone(
-            f"SELECT insrot FROM tel_status WHERE pfs_visit_id={spsVisitId} ORDER BY status_sequence_id DESC LIMIT 1")
-        return float(INSROT - INSROT0)
+            return str(group_name)
 
-    def insert(self, table, **kwargs):
-        """Simple insert into opDB, raising proper IicException."""
-        df = pd.DataFrame(dict([(k, [v]) for k, v in kwargs.items()]))
+        return self.groupNames.get(int(group_id), load)
 
-        try:
-            self.opdb.insert_dataframe(table, df=df)
-        except Exception as e:
-            raise exception.OpdbInsertFailed(table, e)
+    def fetchVisit0INSROT(self, visit0):
+        """Get INSROT at convergence, only queried once per visit0."""
+        return self.visit0INSROT.get(int(visit0), lambda: float(self.queryone('visit0INSROT',
+                                                                             pfs_visit_id=int(visit0))))
 
-    def insertSequence(self, group_id, sequence_type, name, comments, cmd_str, doRetry=True, waitBetweenAttempt=1):
-        """Insert into iic_sequence table. """
-        # new_sequence_id = last + 1
-        new_sequence_id = self.fetchLastSequenceId() + 1
-        kwargs = dict(iic_sequence_id=int(new_sequence_id), group_id=group_id,
-                      sequence_type=str(sequence_type), name=str(name), comments=str(comments), cmd_str=str(cmd_str),
-                      created_at=pd.Timestamp.now())
+    def fetchVisitINSROT(self, pfs_visit_id):
+        """Get latest INSROT recorded for that visit."""
+        return float(self.queryone('visitINSROT', pfs_visit_id=int(pfs_visit_id)))
 
-        df = pd.DataFrame(dict([(k, [v]) for k, v in kwargs.items()]))
-        df["group_id"] = pd.Series(df["group_id"], dtype="Int64")
+    def insert(self, table, **kwargs):
+        """Simple insert into opDB, raising proper IicException."""
+        self.insertRows(table, list(kwargs.keys()), [tuple(kwargs.values())])
 
-        try:
-            self.opdb.insert_dataframe('iic_sequence', df)
-        # concurrent insert can fail.
-        except Exception as e:
-            if doRetry:
-                time.sleep(waitBetweenAttempt)
-                return self.insertSequence(group_id, sequence_type, name, comments, cmd_str, doRetry=False)
+    def insertRows(self, table, columns, rows, batchSize=100):
+        """Insert rows (tuples matching columns) through cached prepared statements, batchSize rows at a time."""
+        for start in range(0, len(rows), batchSize):
+            batch = rows[start:start + batchSize]
+            name = self.queries.insertStatement(table, columns, nRows=len(batch))
+            params = dict([(f'{column}_{iRow}', value) for iRow, row in enumerate(batch)
+                           for column, value in zip(columns, row)])
 
-            raise exception.OpdbInsertFailed('iic_sequence', e)
+            try:
+                self.run(name, **params)
+            except Exception as e:
+                raise exception.OpdbInsertFailed(table, e)
 
-        return new_sequence_id
+    def insertSequence(self, group_id, sequence_type, name, comments, cmd_str):
+        """Insert into iic_sequence table. """
+        group_id = None if group_id is None else int(group_id)
+        return self.allocate('insertSequence', 'iic_sequence', group_id=group_id, sequence_type=str(sequence_type),
+                             name=str(name), comments=str(comments), cmd_str=str(cmd_str),
+                             created_at=datetime.datetime.now())
 
     def insertVisitSet(self, caller, pfs_visit_id, sequence_id):
-        """Insert into visit_set table."""
-
-        def exposureTablePopulated():
-            """Check is there is a matching visit in exposure table."""
-            return not self.fetch(f'SELECT pfs_visit_id FROM {exposure_table} WHERE pfs_visit_id={pfs_visit_id}').empty
-
-        def visitSetPopulated():
-            """Check if visit_set table is already populated."""
-            return not self.fetch(f'SELECT pfs_visit_id FROM visit_set WHERE pfs_visit_id={pfs_visit_id}').empty
+        """Insert into visit_set table, in the background.
 
+        Returns
+        -------
+        str or None
+            writeVisitSet outcome if written right away, 'ignored' for AG commands, None if queued, in which case the
+            outcome is counted by the write-behind queue.
+        """
         # AG commands are ignored when it comes to visit_set, with the current database design there can be ONLY ONE
         # iic_sequence_id per pfs_visit_id, so I choose to give the priority to sps/fps sequence
         # agFocusSweep is the only exception, in that case agFocusSweep is passed as caller to bypass that rule.
         if caller == 'ag':
-            return
+            return 'ignored'
+
+        return self.defer('writeVisitSet', caller=caller, pfs_visit_id=int(pfs_visit_id),
+                          sequence_id=int(sequence_id))
+
+    def writeVisitSet(self, caller, pfs_visit_id, sequence_id):
+        """Insert into visit_set table in a single round trip.
 
+        Returns
+        -------
+        str
+            'inserted', 'exists' if visit_set already has that visit, 'noExposure' if the exposure row is missing.
+        """
         tables = dict(sps='sps_exposure', fps='mcs_exposure', mcs='mcs_exposure', ag='agc_exposure')
 
         # agFocusSweep is the only exception.
@@ -136,40 +200,85 @@ class OpdbHandler:
 
         exposure_table = tables[caller]
 
-        if not exposureTablePopulated():
+        # both checks and the insert are evaluated by the database at once.
+        try:
+            __, [(exposureExists, wasInserted)] = self.run(f'insertVisitSet_{exposure_table}',
+                                                           pfs_visit_id=int(pfs_visit_id),
+                                                           iic_sequence_id=int(sequence_id))
+        except Exception as e:
+            raise exception.OpdbInsertFailed('visit_set', e)
+
+        if not exposureExists:
             logging.warning(f'no entry for {exposure_table}.pfs_visit_id={pfs_visit_id}.')
-            return
+            return 'noExposure'
 
-        if visitSetPopulated():
+        if not wasInserted:
             logging.info(f'caller={caller} visit_set.pfs_visit_id={pfs_visit_id} already exists...')
-            return
+            return 'exists'
 
-        self.insert('visit_set', pfs_visit_id=int(pfs_visit_id), iic_sequence_id=int(sequence_id))
+        return 'inserted'
 
     def insertSequenceStatus(self, sequence_id, status):
-        """Insert into iic_sequence_status table."""
-        self.insert('iic_sequence_status', iic_sequence_id=int(sequence_id), finished_at=pd.Timestamp.now(),
+        """Insert into iic_sequence_status table right away, scienceTracesByGroup reads it back."""
+        self.insert('iic_sequence_status', iic_sequence_id=int(sequence_id), finished_at=datetime.datetime.now(),
                     **status.toOpDB())
 
     def insertSequenceGroup(self, group_name):
-        """Insert into sequence_group table. """
-        # new_group_id = last + 1
-        new_group_id = self.fetchLastGroupId() + 1
-        self.insert('sequence_group', group_id=int(new_group_id), group_name=group_name, created_at=pd.Timestamp.now())
-        return new_group_id
+        """Insert into sequence_group table, and fill group caches. """
+        group_id = self.allocate('insertSequenceGroup', 'sequence_group', group_name=str(group_name),
+                                 created_at=datetime.datetime.now())
+
+        self.groupNames.set(group_id, str(group_name))
+        self.lastGroupIds.set(str(group_name), group_id)
+        self.lastGroupIds.set(None, group_id)
+
+        return group_id
+
+    def invalidateGroupCache(self):
+        """Forget every cached group name and group id."""
+        self.groupNames.invalidate()
+        self.lastGroupIds.invalidate()
+
+    def genCacheKeys(self, cmd):
+        """Generate groupCache keyword, size, hits and misses for group names and last group ids."""
+        cmd.inform(f'groupCache={self.groupNames},{self.lastGroupIds}')
+        cmd.inform(f'knownDesignIds={len(self.knownDesignIds)}')
+
+    def prefetchDesignIds(self):
+        """Load every pfsDesignId already ingested, in a single query."""
+        try:
+            df = self.query('allDesignIds')
+        except exception.OpDBFailure as e:
+            logging.warning(f'could not prefetch pfsDesignIds: {e}')
+            return
+
+        self.knownDesignIds.update(df.pfs_design_id.astype(int).tolist())
+        logging.info(f'{len(self.knownDesignIds)} pfsDesignIds prefetched from opdb')
+
+    def isDesignIngested(self, pfsDesignId):
+        """Check the in-memory index first, opdb only for designs not seen yet."""
+        if pfsDesignId in self.knownDesignIds:
+            return True
+
+        if self.queryone('countPfsDesign', pfs_design_id=pfsDesignId) == 0:
+            return False
+
+        self.knownDesignIds.add(pfsDesignId)
+        return True
 
     def insertPfsConfigSps(self, pfs_visit_id, visit0, camMask, instStatusFlag):
-        """Insert into pfs_config_sps table."""
-        self.insert('pfs_config_sps', pfs_visit_id=int(pfs_visit_id), visit0=int(visit0),
-                    cam_mask=camMask, inst_status_flag=int(instStatusFlag))
+        """Insert into pfs_config_sps table, in the background."""
+        self.defer('insert', table='pfs_config_sps', pfs_visit_id=int(pfs_visit_id), visit0=int(visit0),
+                   cam_mask=int(camMask), inst_status_flag=int(instStatusFlag))
 
     def ingest(self, cmd, pfsDesign, designed_at=None):
         """Inserting into opdb."""
-        isNew = self.fetchone(f'select count(*) from pfs_design where pfs_design_id={pfsDesign.pfsDesignId}') == 0
+        isNew = not self.isDesignIngested(int(pfsDesign.pfsDesignId))
 
         if isNew:
             try:
                 ingestPfsDesign.ingestPfsDesign(pfsDesign, designed_at=designed_at)
+                self.knownDesignIds.add(int(pfsDesign.pfsDesignId))
                 cmd.inform('text="pfsDesign-0x%016x successfully inserted in opdb !"' % pfsDesign.pfsDesignId)
             except Exception as e:
                 cmd.warn(f'text="ingestPfsDesign failed with {str(e)}, ignoring for now..."')
@@ -179,10 +288,10 @@ class OpdbHandler:
     def latestDesignIdMatchingName(self, designName, exact=False):
         """Retrieve last designId matching the name"""
         # be strict about the name if exact==True
-        condition = f"design_name='{designName}'" if exact else f"substring(design_name,1,{len(designName)})='{designName}'"
-        sql = f"select pfs_design_id from pfs_design where {condition} order by to_be_observed_at desc limit 1"
-
-        df = self.fetch(sql)
+        if exact:
+            df = self.query('designIdMatchingName', design_name=str(designName))
+        else:
+            df = self.query('designIdMatchingNamePrefix', design_name=str(designName), length=len(designName))
 
         if df.empty:
             raise RuntimeError(f'could not retrieve {designName} designId from opdb')
@@ -191,7 +300,7 @@ class OpdbHandler:
 
     def designIdFromVariant(self, designId0, variant):
         """Retrieve actual designId from designId0 and variant"""
-        df = self.fetch(f'select pfs_design_id from pfs_design where design_id0={designId0} and variant={variant}')
+        df = self.query('designIdFromVariant', design_id0=int(designId0), variant=int(variant))
 
         if df.empty:
             raise ValueError(f'could not retrieve variant {variant} where design_id0={designId0}')
@@ -200,7 +309,7 @@ class OpdbHandler:
 
     def maxVariantMatchingDesignId0(self, designId0):
         """Retrieve actual designId from designId0 and variant"""
-        maxVariant = self.fetchone(f'select max(variant) from pfs_design where design_id0={designId0}')
+        maxVariant = self.queryone('maxVariant', design_id0=int(designId0))
 
         if pd.isna(maxVariant):
             raise ValueError(f'could not retrieve pfs_design where design_id0={designId0}')
@@ -208,23 +317,15 @@ class OpdbHandler:
         return int(maxVariant)
 
     def getAllVariants(self, designId0):
-        return self.fetch(f'select pfs_design_id,variant from pfs_design where design_id0={designId0}')
+        return self.query('allVariants', design_id0=int(designId0))
 
     def latestThetaPhiScanId(self, groupName='thetaPhiThroughputScan'):
         """Retrieve last thetaPhiThroughputScan groupId"""
-        sql = f"""select max(group_id) from sequence_group where group_name='{groupName}'"""
-        return self.fetchone(sql)
+        return self.queryone('lastGroupIdMatchingName', group_name=str(groupName))
 
     def _fetchScienceTracesByGroup(self, groupId):
         """Return finished scienceTrace rows for a groupId."""
-        sql = (f'select iic_sequence.name, iic_sequence.comments '
-               f'from iic_sequence '
-               f'inner join iic_sequence_status '
-               f'on iic_sequence_status.iic_sequence_id=iic_sequence.iic_sequence_id '
-               f'where iic_sequence.group_id={groupId} '
-               f"and iic_sequence.sequence_type='scienceTrace' "
-               f'and iic_sequence_status.status_flag={Flag.FINISHED}')
-        return self.fetch(sql)
+        return self.query('scienceTracesByGroup', group_id=int(groupId))
 
     def _getScannedAngles(self, groupId, constantAxis, scanAngles):
         """Return outer angles fully scanned (all scanAngles present and finished) under this groupId."""
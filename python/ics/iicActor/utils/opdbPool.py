@@ -0,0 +1,60 @@
+import logging
+import threading
+
+import sqlalchemy
+from pfs.utils.database import opdb
+
+
+class OpdbPool(object):
+    """Single opdb engine shared by all threads, connections are checked by sqlalchemy on checkout (pool_pre_ping)."""
+
+    def __init__(self, poolSize=5, maxOverflow=10, recycle=3600):
+        self.logger = logging.getLogger('opdbPool')
+        self.lock = threading.Lock()
+
+        # only borrow opdb url, every statement goes through that single engine.
+        db = opdb.OpDB()
+        self.engine = sqlalchemy.create_engine(db.engine.url, pool_pre_ping=True, pool_size=int(poolSize),
+                                               max_overflow=int(maxOverflow), pool_recycle=int(recycle))
+        db.engine.dispose()
+
+        self.nRuns = 0
+        self.nRetries = 0
+
+    def __str__(self):
+        pool = self.engine.pool
+        return f'opdbPool={pool.size()},{pool.checkedout()},{self.nRuns},{self.nRetries}'
+
+    @classmethod
+    def fromConfig(cls, config):
+        """Pool sized from the opdbPoolSize, opdbMaxOverflow and opdbPoolRecycle engine knobs."""
+        return cls(poolSize=config.get('opdbPoolSize', 5), maxOverflow=config.get('opdbMaxOverflow', 10),
+                   recycle=config.get('opdbPoolRecycle', 3600))
+
+    def run(self, func, retry=False):
+        """Run func(connection) in its own transaction.
+
+        The connection can still be lost during the transaction itself, only retry once if allowed to, which is for
+        reads and idempotent statements only.
+        """
+        with self.lock:
+            self.nRuns += 1
+
+        try:
+            with self.engine.begin() as connection:
+                return func(connection)
+        except sqlalchemy.exc.DBAPIError as e:
+            if not (retry and e.connection_invalidated):
+                raise
+
+        self.logger.warning('opdb connection lost, retrying...')
+
+        with self.lock:
+            self.nRetries += 1
+
+        with self.engine.begin() as connection:
+            return func(connection)
+
+    def genKeys(self, cmd):
+        """Generate opdbPool keyword."""
+        cmd.inform(str(self))
@@ -0,0 +1,147 @@
+import re
+import threading
+import time
+
+import sqlalchemy
+from ics.iicActor.utils.sequenceStatus import Flag
+
+
+class Statement(object):
+    """Named, parameterized statement, prepared server-side once per connection."""
+    paramRegex = re.compile(r'(?<![:\w]):(\w+)')
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = ' '.join(sql.split())
+        self.text = sqlalchemy.text(self.sql)
+        self.params = list(dict.fromkeys(Statement.paramRegex.findall(self.sql)))
+        # safe to run again if the connection was lost halfway.
+        self.isReadOnly = self.sql.upper().startswith('SELECT')
+
+        # postgres syntax, positional parameters.
+        positional = Statement.paramRegex.sub(lambda match: f'${self.params.index(match.group(1)) + 1}', self.sql)
+        self.prepareSql = f'PREPARE {self.name} AS {positional}'
+        args = ', '.join([f'%({param})s' for param in self.params])
+        self.executeSql = f'EXECUTE {self.name}({args})' if args else f'EXECUTE {self.name}'
+
+        self.lock = threading.Lock()
+        self.nCalls = 0
+        self.totalTime = 0
+        self.maxTime = 0
+
+    def __str__(self):
+        meanTime = self.totalTime / self.nCalls if self.nCalls else 0
+        return f'opdbStatement={self.name},{self.nCalls},{meanTime * 1000:.1f},{self.maxTime * 1000:.1f}'
+
+    def run(self, connection, prepare=True, **params):
+        """Execute statement on a sqlalchemy connection, preparing it first if needed, and time it."""
+        start = time.monotonic()
+
+        if prepare:
+            # connection.info lives as long as the underlying dbapi connection.
+            prepared = connection.info.setdefault('preparedStatements', set())
+
+            if self.name not in prepared:
+                connection.exec_driver_sql(self.prepareSql)
+                prepared.add(self.name)
+
+            result = connection.exec_driver_sql(self.executeSql, params)
+        else:
+            result = connection.execute(self.text, params)
+
+        rows = result.fetchall() if result.returns_rows else []
+        columns = list(result.keys()) if result.returns_rows else []
+
+        elapsed = time.monotonic() - start
+        with self.lock:
+            self.nCalls += 1
+            self.totalTime += elapsed
+            self.maxTime = max(self.maxTime, elapsed)
+
+        return columns, rows
+
+
+class QueryCatalog(dict):
+    """All statements OpdbHandler is using, by name."""
+
+    def __init__(self, prepare=True):
+        super().__init__()
+        self.prepare = prepare
+        # generated insert statements, by (table, columns, nRows).
+        self.inserts = dict()
+        self.lock = threading.Lock()
+
+        self.add('lastGroupId', 'SELECT max(group_id) FROM sequence_group')
+        self.add('lastGroupIdMatchingName', 'SELECT max(group_id) FROM sequence_group WHERE group_name=:group_name')
+        self.add('groupNameFromGroupId', 'SELECT group_name FROM sequence_group WHERE group_id=:group_id')
+        self.add('visit0INSROT', "SELECT insrot FROM tel_status WHERE pfs_visit_id=:pfs_visit_id and caller='mcs' "
+                                 "ORDER BY status_sequence_id DESC LIMIT 1")
+        self.add('visitINSROT', 'SELECT insrot FROM tel_status WHERE pfs_visit_id=:pfs_visit_id '
+                                'ORDER BY status_sequence_id DESC LIMIT 1')
+        self.add('allDesignIds', 'SELECT pfs_design_id FROM pfs_design')
+        self.add('countPfsDesign', 'SELECT count(*) FROM pfs_design WHERE pfs_design_id=:pfs_design_id')
+        self.add('designIdMatchingName', 'SELECT pfs_design_id FROM pfs_design WHERE design_name=:design_name '
+                                         'ORDER BY to_be_observed_at DESC LIMIT 1')
+        self.add('designIdMatchingNamePrefix', 'SELECT pfs_design_id FROM pfs_design '
+                                               'WHERE substring(design_name, 1, :length)=:design_name '
+                                               'ORDER BY to_be_observed_at DESC LIMIT 1')
+        self.add('designIdFromVariant', 'SELECT pfs_design_id FROM pfs_design '
+                                        'WHERE design_id0=:design_id0 and variant=:variant')
+        self.add('maxVariant', 'SELECT max(variant) FROM pfs_design WHERE design_id0=:design_id0')
+        self.add('allVariants', 'SELECT pfs_design_id,variant FROM pfs_design WHERE design_id0=:design_id0')
+        self.add('scienceTracesByGroup', f'SELECT iic_sequence.name, iic_sequence.comments FROM iic_sequence '
+                                         f'INNER JOIN iic_sequence_status '
+                                         f'ON iic_sequence_status.iic_sequence_id=iic_sequence.iic_sequence_id '
+                                         f'WHERE iic_sequence.group_id=:group_id '
+                                         f"and iic_sequence.sequence_type='scienceTrace' "
+                                         f'and iic_sequence_status.status_flag={Flag.FINISHED}')
+
+        # id is allocated by the insert itself.
+        self.add('insertSequence', 'INSERT INTO iic_sequence '
+                                   '(iic_sequence_id, group_id, sequence_type, name, comments, cmd_str, created_at) '
+                                   'SELECT coalesce(max(iic_sequence_id), 0) + 1, CAST(:group_id AS integer), '
+                                   'CAST(:sequence_type AS text), CAST(:name AS text), CAST(:comments AS text), '
+                                   'CAST(:cmd_str AS text), CAST(:created_at AS timestamp) FROM iic_sequence '
+                                   'RETURNING iic_sequence_id')
+        self.add('insertSequenceGroup', 'INSERT INTO sequence_group (group_id, group_name, created_at) '
+                                        'SELECT coalesce(max(group_id), 0) + 1, CAST(:group_name AS text), '
+                                        'CAST(:created_at AS timestamp) FROM sequence_group '
+                                        'RETURNING group_id')
+
+        # both checks and the insert are evaluated by the database at once.
+        for exposureTable in ['sps_exposure', 'mcs_exposure', 'agc_exposure']:
+            self.add(f'insertVisitSet_{exposureTable}',
+                     f'WITH exposure AS (SELECT 1 FROM {exposureTable} WHERE pfs_visit_id=:pfs_visit_id LIMIT 1), '
+                     f'existing AS (SELECT 1 FROM visit_set WHERE pfs_visit_id=:pfs_visit_id LIMIT 1), '
+                     f'inserted AS (INSERT INTO visit_set (pfs_visit_id, iic_sequence_id) '
+                     f'SELECT CAST(:pfs_visit_id AS integer), CAST(:iic_sequence_id AS integer) '
+                     f'WHERE EXISTS (SELECT 1 FROM exposure) AND NOT EXISTS (SELECT 1 FROM existing) '
+                     f'ON CONFLICT DO NOTHING RETURNING 1) '
+                     f'SELECT EXISTS (SELECT 1 FROM exposure), EXISTS (SELECT 1 FROM inserted)')
+
+    def add(self, name, sql):
+        self[name] = Statement(name, sql)
+
+    def insertStatement(self, table, columns, nRows=1):
+        """Return name of the multi-row insert statement for table and columns, generated on first use."""
+        key = (table, tuple(columns), nRows)
+
+        with self.lock:
+            if key not in self.inserts:
+                name = f'insert_{table}_{len(self.inserts)}'
+                values = ', '.join(['(' + ', '.join([f':{column}_{iRow}' for column in columns]) + ')'
+                                    for iRow in range(nRows)])
+                self.add(name, f'INSERT INTO {table} ({", ".join(columns)}) VALUES {values}')
+                self.inserts[key] = name
+
+            return self.inserts[key]
+
+    def run(self, connection, name, **params):
+        """Execute named statement."""
+        return self[name].run(connection, prepare=self.prepare, **params)
+
+    def genKeys(self, cmd):
+        """Generate one opdbStatement keyword per statement that has been used."""
+        for statement in list(self.values()):
+            if statement.nCalls:
+                cmd.inform(str(statement))
@@ -30,16 +30,17 @@ class Resource(object):
         return self.available
 
     def lock(self, state):
-        """Lock the resource if available, or raise if already locked."""
+        """Lock the resource if available, or raise if already locked, return True only if actually locked here."""
         if not self.available:
             # Already locked — no conflict if same state
             if state != Resource.default and self.state == state:
-                return
+                return False
 
             raise exception.ResourceIsBusy(f'{self.name} already busy.')
 
         self.available = False
         self.state = state
+        return True
 
     def free(self):
         """Free the resource and reset to default state."""
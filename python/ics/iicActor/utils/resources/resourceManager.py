@@ -1,12 +1,33 @@
 import logging
+import queue
+import threading
 
 import ics.iicActor.utils.lib as libUtils
+import ics.utils.time as pfsTime
 from ics.iicActor.sps.sequence import SpsSequence
 from ics.iicActor.utils import exception
 from ics.iicActor.utils.resources import resource
 from ics.utils.sps.config import SpsConfig
 
 
+class Waiter(object):
+    """Placeholder for a resource request waiting in line."""
+
+    def __init__(self, resources, timeout, onGranted, onRejected, cmd=None):
+        self.resources = resources
+        self.names = set([resource.Resource.translate(required)[0] for required in resources])
+        self.timeout = timeout
+        self.deadline = pfsTime.timestamp() + timeout
+        self.onGranted = onGranted
+        self.onRejected = onRejected
+        self.cmd = cmd
+        self.position = None
+
+    def overlaps(self, other):
+        """Return True if both waiters share at least one resource."""
+        return bool(self.names & other.names)
+
+
 class ResourceManager(object):
     """Manage software/hardware resource availability and locking for actor commands."""
 
@@ -19,12 +40,24 @@ class ResourceManager(object):
         self.connectedActors = dict()
         self.spsResources = dict()
         self.spsConfig = None
+        # combined index of connected actor and SPS resources, kept up to date by the callbacks.
+        self.resources = dict()
+        # resource requests waiting for busy resources, earlier requests are served first.
+        self.waiters = []
+        # guard every check/lock/free, reentrant so that acquire can call request.
+        self.condition = threading.Condition(threading.RLock())
+        # number of requests which found at least one resource busy.
+        self.nContentions = 0
         self.attachCallbacks()
 
-    @property
-    def resources(self):
-        """Return a combined dict of connected actor and SPS resources."""
-        return dict([it for it in self.connectedActors.items()] + [it for it in self.spsResources.items()])
+        # waiters are served by a dedicated thread, so that no engine worker is held while waiting in line.
+        self.waiterThread = threading.Thread(target=self.serveWaiters, name='resourceWaiter', daemon=True)
+        self.waiterThread.start()
+
+    def reindex(self):
+        """Rebuild the combined resource index, SPS parts take precedence."""
+        with self.condition:
+            self.resources = dict([it for it in self.connectedActors.items()] + [it for it in self.spsResources.items()])
 
     def attachCallbacks(self):
         """Attach hub/sps model callbacks to track resource availability."""
@@ -45,6 +78,8 @@ class ResourceManager(object):
             for actorName in disconnected:
                 self.connectedActors.pop(actorName, None)
 
+            self.reindex()
+
         def spsConfig(keyVar):
             """Track changes to spsModules and reload related resources."""
             self.spsConfig = self.reloadSpsResources()
@@ -73,95 +108,252 @@ class ResourceManager(object):
         for partName in disconnected:
             self.spsResources.pop(partName, None)
 
+        self.reindex()
+
         return spsConfig
 
     def request(self, resources):
-        """Try to lock a list of resource names, raise if unavailable."""
+        """Lock a list of resource names, all or nothing, raise if unavailable."""
         notConnected = []
         isBusy = []
         locked = []
 
-        for required in resources:
-            required, state = resource.Resource.translate(required)
+        # consistent global order.
+        resources = sorted(set(resources))
+
+        with self.condition:
+            for required in resources:
+                required, state = resource.Resource.translate(required)
+
+                # checking for unconnected resources.
+                if required not in self.resources:
+                    notConnected.append(required)
+                    continue
+                # checking for unavailable resources.
+                if not self.resources[required].isAvailable(state):
+                    isBusy.append(required)
+
+            if notConnected:
+                raise exception.ResourceUnAvailable(f'{",".join(notConnected)} not connected.')
+
+            if isBusy:
+                self.nContentions += 1
+                raise exception.ResourceIsBusy(f'{",".join(isBusy)} already busy.')
+
+            # all tests have passed we can lock everything down
+            self.logger.info(f'locking resources : {",".join(resources)}')
+
+            # resources already held by someone else in the same state are shared, they must not be rolled back.
+            lockedHere = []
+
+            try:
+                for required in resources:
+                    required, state = resource.Resource.translate(required)
+                    if self.resources[required].lock(state):
+                        lockedHere.append(required)
+                    # keeping only the locked resources.
+                    locked.append(required)
+            except Exception:
+                # roll back, nothing this call has locked stays locked.
+                for required in lockedHere:
+                    self.resources[required].free()
+                raise
+
+        return locked
 
-            # checking for unconnected resources.
-            if required not in self.resources:
-                notConnected.append(required)
+    def acquire(self, resources, timeout=0, cmd=None):
+        """Lock a list of resource names, waiting in line up to timeout seconds if any of them is busy.
+
+        The calling thread is blocked while waiting, see enqueue for the non-blocking counterpart.
+        """
+        names = set([resource.Resource.translate(required)[0] for required in resources])
+
+        with self.condition:
+            try:
+                # do not jump the queue, if someone is already waiting for the same resources and could have them.
+                if any(other.names & names and self.isGrantable(other) for other in self.waiters):
+                    self.nContentions += 1
+                    raise exception.ResourceIsBusy(f'{",".join(sorted(names))} already requested.')
+
+                return self.request(resources)
+            except exception.ResourceIsBusy:
+                if not timeout:
+                    raise
+
+        outcome = queue.Queue()
+        self.enqueue(resources, timeout, onGranted=outcome.put, onRejected=outcome.put, cmd=cmd)
+        locked = outcome.get()
+
+        if isinstance(locked, Exception):
+            raise locked
+
+        return locked
+
+    def enqueue(self, resources, timeout, onGranted, onRejected, cmd=None):
+        """Wait in line up to timeout seconds, the waiter thread fires onGranted(locked) or onRejected(exception)."""
+        waiter = Waiter(resources, timeout, onGranted, onRejected, cmd=cmd)
+
+        with self.condition:
+            self.waiters.append(waiter)
+            self.genQueueKeys(waiter)
+            self.condition.notify_all()
+
+    def serveWaiters(self):
+        """Waiter thread loop, process waiters whenever resources are freed or a deadline is reached."""
+        while True:
+            with self.condition:
+                granted, rejected = self.processWaiters()
+
+                if not granted and not rejected:
+                    deadlines = [waiter.deadline for waiter in self.waiters]
+                    timeout = max(min(deadlines) - pfsTime.timestamp(), 0) if deadlines else None
+                    self.condition.wait(timeout)
+                    continue
+
+            # callbacks are fired outside the lock.
+            for callback, arg in [(waiter.onGranted, locked) for waiter, locked in granted] + \
+                                 [(waiter.onRejected, e) for waiter, e in rejected]:
+                try:
+                    callback(arg)
+                except Exception:
+                    self.logger.exception('uncaught exception in resource waiter callback')
+
+    def processWaiters(self):
+        """Lock resources for every waiter which can have them, earlier waiters first, reject those which have expired.
+
+        A waiter does not hold back later waiters while its own resources are busy, so a request for free resources
+        is granted right away, unless an earlier waiter can be served with some of them.
+        """
+        granted = []
+        rejected = []
+        now = pfsTime.timestamp()
+
+        for waiter in list(self.waiters):
+            try:
+                granted.append((waiter, self.request(waiter.resources)))
+                self.waiters.remove(waiter)
+                continue
+            except exception.ResourceIsBusy:
+                pass
+            except Exception as e:
+                rejected.append((waiter, e))
+                self.waiters.remove(waiter)
                 continue
-            # checking for unavailable resources.
-            if not self.resources[required].isAvailable(state):
-                isBusy.append(required)
 
-        if notConnected:
-            raise exception.ResourceUnAvailable(f'{",".join(notConnected)} not connected.')
+            if now >= waiter.deadline:
+                names = ",".join(sorted(waiter.names))
+                rejected.append((waiter, exception.ResourceIsBusy(f'{names} still busy after {waiter.timeout}s.')))
+                self.waiters.remove(waiter)
 
-        if isBusy:
-            raise exception.ResourceIsBusy(f'{",".join(isBusy)} already busy.')
+        # report position whenever it changes.
+        for waiter in self.waiters:
+            self.genQueueKeys(waiter)
 
-        # all tests have passed we can lock everything down
-        self.logger.info(f'locking resources : {",".join(resources)}')
+        return granted, rejected
 
-        for required in resources:
+    def isGrantable(self, waiter):
+        """Return True if all waiter resources are connected and available."""
+        for required in waiter.resources:
             required, state = resource.Resource.translate(required)
-            self.resources[required].lock(state)
-            # keeping only the locked resources.
-            locked.append(required)
 
-        return locked
+            if required not in self.resources or not self.resources[required].isAvailable(state):
+                return False
+
+        return True
+
+    def queuePosition(self, waiter):
+        """Return waiter position among the waiters sharing resources, starting at 1."""
+        ahead = [other for other in self.waiters[:self.waiters.index(waiter)] if other.overlaps(waiter)]
+        return len(ahead) + 1
+
+    def genQueueKeys(self, waiter):
+        """Generate resourceQueue keyword, only if waiter position has changed."""
+        position = self.queuePosition(waiter)
+
+        if waiter.cmd is None or position == waiter.position:
+            return
+
+        waiter.position = position
+        waiter.cmd.inform(f'resourceQueue={position},{len(self.waiters)},"{",".join(sorted(waiter.names))}"')
 
     def free(self, locked):
         """Free a list of locked resource names."""
-        locked = [key for key in locked if key in self.resources and not self.resources[key].available]
+        with self.condition:
+            locked = [key for key in locked if key in self.resources and not self.resources[key].available]
 
-        # if nothing to be freed just return.
-        if not locked:
-            return
+            # if nothing to be freed just return.
+            if not locked:
+                return
 
-        self.logger.info(f'freeing resources : {",".join(locked)}')
-        for resource in locked:
-            self.resources[resource].free()
+            self.logger.info(f'freeing resources : {",".join(locked)}')
 
-    def inspect(self, sequence):
-        """Extract required resources from a given command sequence."""
-        # just get the list of all actors that will be called as start.
-        allDeps = list(set([subCmd.actor for subCmd in sequence.subCmds]))
+            for resource in locked:
+                self.resources[resource].free()
 
-        # MCS implicitly needed for some FPS commands
-        if 'fps' in allDeps:
-            for fpsCommand in list(set([subCmd.cmdHead for subCmd in sequence.subCmds if subCmd.actor == 'fps'])):
-                # This command requires fps only, might be the only one, actually.
-                if fpsCommand in ['cobraMoveSteps', 'calculateBoresight']:
-                    continue
+            # wake up the waiters.
+            self.condition.notify_all()
+
+    def genKeys(self, cmd):
+        """Generate resourceManager keyword."""
+        with self.condition:
+            nLocked = len([res for res in self.resources.values() if not res.available])
+            cmd.inform(f'resourceManager={len(self.resources)},{nLocked},{len(self.waiters)},{self.nContentions}')
 
-                allDeps.append('mcs')
+    def inspect(self, sequence):
+        """Extract required resources from a given command sequence, each subCmd carries its own footprint."""
+        spsDeps = None
 
         # sps is somehow peculiar because it's not driving hardware directly just actors (enu, xcu, ccd...).
-        if 'sps' in allDeps:
-            allDeps.remove('sps')
-            if isinstance(sequence, SpsSequence):
-                if sequence.noDeps:  # just cams
-                    deps = list(map(str, sequence.cams))
-                else:
-                    # dependencies are derived from cams.
-                    deps = list(set(map(str, sum([cam.dependencies(sequence) for cam in sequence.cams], []))))
-                allDeps.extend(deps)
+        if isinstance(sequence, SpsSequence) and any(subCmd.actor == 'sps' for subCmd in sequence.subCmds):
+            if sequence.noDeps:  # just cams
+                spsDeps = list(map(str, sequence.cams))
             else:
-                for spsCommand in list(set([subCmd for subCmd in sequence.subCmds if subCmd.actor == 'sps'])):
-                    # selecting spectrograph modules from the command inputs.
-                    specNums = libUtils.identSpecNums(spsCommand.cmdStr)
-                    specModules = self.spsConfig.selectModules(specNums)
-                    # select resource based on cmdHead.
-                    if spsCommand.cmdHead == 'bia':
-                        allDeps.extend([str(specModule.bia) for specModule in specModules])
-                    elif spsCommand.cmdHead == 'rda':
-                        allDeps.extend([str(specModule.rda) for specModule in specModules])
-                    elif spsCommand.cmdHead == 'slit':
-                        allDeps.extend([str(specModule.fca) for specModule in specModules])
-                    else:
-                        raise RuntimeError(f'dont know what to do with {spsCommand.cmdHead}...')
+                # dependencies are derived from cams.
+                spsDeps = list(set(map(str, sum([cam.dependencies(sequence) for cam in sequence.cams], []))))
+
+        allDeps = []
+
+        for subCmd in sequence.subCmds:
+            subCmd.resources = self.footprint(subCmd, spsDeps=spsDeps)
+            allDeps.extend(subCmd.resources)
+
+        # footprints have changed, remaining counters need to be updated.
+        sequence.recount()
 
         return list(set(allDeps))
 
+    def footprint(self, subCmd, spsDeps=None):
+        """Extract required resources for a single subcommand."""
+        # just get the actor that will be called.
+        deps = [subCmd.actor]
+
+        # MCS implicitly needed for some FPS commands
+        if subCmd.actor == 'fps':
+            # This command requires fps only, might be the only one, actually.
+            if subCmd.cmdHead not in ['cobraMoveSteps', 'calculateBoresight']:
+                deps.append('mcs')
+
+        # sps is somehow peculiar because it's not driving hardware directly just actors (enu, xcu, ccd...).
+        if subCmd.actor == 'sps':
+            deps.remove('sps')
+            if spsDeps is not None:
+                deps.extend(spsDeps)
+            else:
+                # selecting spectrograph modules from the command inputs.
+                specNums = libUtils.identSpecNums(subCmd.cmdStr)
+                specModules = self.spsConfig.selectModules(specNums)
+                # select resource based on cmdHead.
+                if subCmd.cmdHead == 'bia':
+                    deps.extend([str(specModule.bia) for specModule in specModules])
+                elif subCmd.cmdHead == 'rda':
+                    deps.extend([str(specModule.rda) for specModule in specModules])
+                elif subCmd.cmdHead == 'slit':
+                    deps.extend([str(specModule.fca) for specModule in specModules])
+                else:
+                    raise RuntimeError(f'dont know what to do with {subCmd.cmdHead}...')
+
+        return list(set(deps))
+
     def freeEnu(self, keyVar):
         """Free RDA, and FCA resources for the specified spectrograph."""
         specNum = int(keyVar.actor[-1])
@@ -1,6 +1,15 @@
+import collections
+import contextlib
+import functools
+import itertools
+import threading
+
 import ics.utils.time as pfsTime
 from ics.iicActor.utils import exception
+from ics.iicActor.utils.keyEmitter import KeyEmitter
+from ics.iicActor.utils.latency import PhaseTimer
 from ics.iicActor.utils.lib import makeCmdStr
+from ics.iicActor.utils.resources.resource import Resource
 from ics.iicActor.utils.sequenceStatus import Status, Flag
 from ics.iicActor.utils.subcmd import SubCmd
 from ics.utils.fits import mhs as fitsMhs
@@ -9,6 +18,13 @@ from ics.utils.fits import mhs as fitsMhs
 class Sequence(list):
     daysToDeclareObsolete = 7
     seqtype = 'sequence'
+    # parallel group assigned to subcommands being added, None means serial.
+    parallelGroup = None
+    parallelGroupIds = itertools.count(1)
+    # free resources as soon as no remaining subcommand needs them.
+    incrementalRelease = True
+    # can be rebuilt from its original command, see `iic sequence resume`.
+    isResumable = True
 
     def __init__(self, name="", comments="", doTest=False, noDeps=False, head=None, tail=None, groupId=None,
                  cmdKeys=None, **kwargs):
@@ -18,15 +34,28 @@ class Sequence(list):
         self.doTest = doTest
         self.noDeps = noDeps
 
+        # execution cursor, index of the first subcommand which might not have been called yet.
+        self.cursor = 0
+        self.remaining = RemainingCounters(self)
+        # all sequence/subCommand keywords go through the emitter.
+        self.emitter = KeyEmitter(self)
+        # engine phases timing.
+        self.phases = PhaseTimer()
+
         self.head = CmdList(self, head)
         self.tail = CmdList(self, tail)
         self.group_id = groupId
         self.cmdKeys = cmdKeys
 
         self.sequence_id = None
+        # resources locked by the engine for that sequence.
+        self.lockedResources = []
         self.engine = None
         self.cmd = None
         self.cmdStr = None
+        self.rawCmd = None
+        # journaled sequence this one takes over, closed only once that one has actually started.
+        self.resumedFrom = None
 
         self.createdAt = pfsTime.Time.now()
         self.status = Status()
@@ -50,13 +79,61 @@ class Sequence(list):
     def subCmds(self):
         return self.cmdList + self.tail
 
+    @property
+    def nCmds(self):
+        return len(self.head) + len(self)
+
     @property
     def remainingCmds(self):
-        return [subCmd for subCmd in self.cmdList if not subCmd.cmdRet.wasCalled]
+        self.advanceCursor()
+        return [subCmd for subCmd in self.iterCmds(self.cursor) if not subCmd.cmdRet.wasCalled]
+
+    @property
+    def canRunAsync(self):
+        """commandLogicAsync would skip any commandLogic override, run those synchronously."""
+        return type(self).commandLogic is Sequence.commandLogic
 
     @property
     def timeLim(self):
-        return sum([subCmd.timeLim for subCmd in self.remainingCmds])
+        self.remaining.sync()
+        return self.remaining.timeLim
+
+    def subCmdAt(self, index):
+        """Return subCmd at index in cmdList, without building cmdList."""
+        nHead = len(self.head)
+        return self.head[index] if index < nHead else list.__getitem__(self, index - nHead)
+
+    def iterCmds(self, start=0):
+        """Iterate over cmdList from start."""
+        for index in range(start, self.nCmds):
+            yield self.subCmdAt(index)
+
+    def advanceCursor(self):
+        """Move the cursor past the subcommands which have already been called."""
+        while True:
+            self.remaining.sync()
+            nCmds = self.nCmds
+
+            while self.cursor < nCmds and self.subCmdAt(self.cursor).cmdRet.wasCalled:
+                self.cursor += 1
+
+            # build more subcommands if the cursor has reached the end.
+            if self.cursor < nCmds or not self.fetchMore():
+                break
+
+    def fetchMore(self):
+        """Build more subcommands on demand, return True if any was added. Prototype."""
+        return False
+
+    def materialize(self, nCmds):
+        """Make sure that at least nCmds subcommands are built."""
+        while self.nCmds < nCmds and self.fetchMore():
+            pass
+
+    def recount(self):
+        """Count remaining subcommands again, to be called if subcommands have been modified in place."""
+        self.remaining.reset()
+        self.remaining.sync()
 
     def add(self, actor, cmdStr, **kwargs):
         """ Append duplicate * subcommand to sequence """
@@ -71,30 +148,50 @@ class Sequence(list):
         # regular add.
         self.add(*args, **kwargs)
         # declare id and generate keys
-        id = len(self.cmdList) - 1
+        id = self.nCmds - 1
         self[-1].init(id, cmd=cmd)
 
     def genKeys(self, *args):
-        """Generate sequence keyword."""
-        self.getCmd().inform(str(self))
+        """Generate sequence keyword, unless it has not changed."""
+        self.emitter.send(self.getCmd(), str(self), key='sequence')
+
+    def genPhaseKeys(self, cmd):
+        """Generate sequencePhases keyword, duration of each engine phase and dead time in between."""
+        durations = ','.join([f'"{phase}",{duration:.3f}' for phase, duration in self.phases.durations])
+        cmd.inform(f'sequencePhases={self.sequence_id},{self.seqtype},{self.phases.deadTime:.3f},{durations}')
+
+    def attach(self, engine, cmd):
+        """Attach engine and command, no database nor keyword access here."""
+        self.engine = engine
+        self.setCmd(cmd)
 
     def initialize(self, engine, cmd):
         """Attach command"""
-        self.engine = engine
+        self.attach(engine, cmd)
 
         # replacing with actual last groupId.
         if self.group_id == -1:
             self.group_id = self.engine.opdb.fetchLastGroupId()
 
-        self.setCmd(cmd)
-
         # strip name and comments from rawCmd since it is redundant opdb/keyword scheme.
         if self.cmdStr is None:
             self.cmdStr = makeCmdStr(cmd)
 
+        # original command, kept to be able to resume the sequence after a restart.
+        if self.rawCmd is None:
+            self.rawCmd = cmd.rawCmd
+
     def setCmd(self, cmd):
         """Attach command"""
         self.cmd = cmd
+        # someone might be waiting for the command to be released.
+        self.status.notify()
+
+    def releaseCmd(self):
+        """Finish attached command now and let the sequence run in the background."""
+        cmd, self.cmd = self.cmd, None
+        cmd.finish()
+        self.status.notify()
 
     def getCmd(self):
         """Get command objets"""
@@ -108,23 +205,125 @@ class Sequence(list):
                                                            name=self.name,
                                                            comments=self.comments,
                                                            cmd_str=self.cmdStr)
+        # journal definition locally, so it can be resumed if the actor crashes.
+        self.engine.journal.start(self)
         # declare active and generate allKeys.
         self.activate()
 
     def activate(self):
         """Declare sequence as active and generate sequence, subcmd keys."""
         # generate keywords for subCommand to come.
-        for id, subCmd in enumerate(self.subCmds):
-            subCmd.init(id, cmd=self.getCmd())
-
+        self.declare(self.subCmds)
         self.status.ready()
 
+    def declare(self, subCmds, start=0):
+        """Number subcommands from start and generate their keywords."""
+        for id, subCmd in enumerate(subCmds, start=start):
+            subCmd.id = id
+
+        self.emitter.declare(self.getCmd(), subCmds)
+
+    @contextlib.contextmanager
+    def parallel(self):
+        """Subcommands added within that context are dispatched concurrently and joined before moving on."""
+        self.parallelGroup = next(Sequence.parallelGroupIds)
+        try:
+            yield self
+        finally:
+            self.parallelGroup = None
+
+    @staticmethod
+    def batched(subCmds):
+        """Split subCmds into consecutive batches, subcommands sharing the same parallel group are batched together."""
+        batches = []
+
+        for subCmd in subCmds:
+            if batches and subCmd.parallelGroup is not None and subCmd.parallelGroup == batches[-1][-1].parallelGroup:
+                batches[-1].append(subCmd)
+            else:
+                batches.append([subCmd])
+
+        return batches
+
     def getNextSubCmd(self):
         """Get next subCmd in the list."""
-        if not self.remainingCmds:
+        self.advanceCursor()
+
+        if self.cursor >= self.nCmds:
             return None
 
-        return self.remainingCmds[0]
+        return self.subCmdAt(self.cursor)
+
+    def getNextSubCmds(self):
+        """Get next batch of subCmds to be dispatched together."""
+        next = self.getNextSubCmd()
+
+        if next is None:
+            return []
+
+        batch = [next]
+
+        if next.parallelGroup is None:
+            return batch
+
+        for subCmd in self.iterCmds(self.cursor + 1):
+            if subCmd.cmdRet.wasCalled:
+                continue
+            if subCmd.parallelGroup != next.parallelGroup:
+                break
+
+            batch.append(subCmd)
+
+        return batch
+
+    def releaseUnusedResources(self):
+        """Free locked resources that no remaining subcommand, tail included, will need."""
+        if not self.incrementalRelease:
+            return
+
+        self.remaining.sync()
+
+        # footprint is unknown for some subcommand, so cannot tell.
+        if not self.lockedResources or self.remaining.nUnknownFootprint or any(
+                subCmd.resources is None for subCmd in self.tail):
+            return
+
+        needed = set([Resource.translate(required)[0] for subCmd in self.tail for required in subCmd.resources])
+        needed |= set([name for name, count in self.remaining.resources.items() if count > 0])
+        unused = [name for name in self.lockedResources if name not in needed]
+
+        if not unused:
+            return
+
+        # lockedResources is shared with the engine, so update in place.
+        for name in unused:
+            self.lockedResources.remove(name)
+
+        self.engine.resourceManager.free(unused)
+
+    def callSubCmds(self, cmd, subCmds):
+        """Call a batch of subcommands concurrently, raise the first failure once they are all done."""
+        if len(subCmds) == 1:
+            return subCmds[0].callAndUpdate(cmd)
+
+        failures = []
+
+        def call(subCmd):
+            try:
+                subCmd.callAndUpdate(cmd)
+            except Exception as e:
+                failures.append(e)
+
+        threads = [threading.Thread(target=call, args=(subCmd,), daemon=True) for subCmd in subCmds]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            raise failures[0]
 
     def commandLogic(self):
         """Contain all the logic to process a sequence."""
@@ -138,17 +337,20 @@ class Sequence(list):
         cmd = self.getCmd()
 
         while not self.status.isFlagged and self.getNextSubCmd():
-            # get next subCommand.
-            next = self.getNextSubCmd()
+            # get next subCommand(s), more than one if they belong to the same parallel group.
+            next = self.getNextSubCmds()
 
-            # call next command, raise exception and stop here if any failure.
+            # call next command(s), raise exception and stop here if any failure.
             try:
-                next.callAndUpdate(cmd)
+                self.callSubCmds(cmd, next)
             except Exception as e:
                 cancelRemainings(cmd)
                 self.status.conclude(failure=str(e))
                 raise
 
+            # let other sequences use what is not needed anymore.
+            self.releaseUnusedResources()
+
         # sequence could have been finished/aborted externally, so just clean the remaining ones.
         if self.remainingCmds:
             cancelRemainings(cmd)
@@ -159,24 +361,91 @@ class Sequence(list):
         if self.status.isAborted:
             raise exception.SequenceAborted()
 
+    def commandLogicAsync(self, onConcluded):
+        """Non-blocking counterpart of commandLogic, onConcluded(failure) is fired once the sequence is concluded."""
+        lock = threading.Lock()
+        cmd = self.getCmd()
+
+        def cancelRemainings():
+            """ Release remaining subcommand"""
+            for subCmd in self.remainingCmds:
+                subCmd.cancel(cmd)
+
+        def conclude(failure=None):
+            """Conclude the sequence and pass the failure, if any."""
+            # sequence could have been finished/aborted externally, so just clean the remaining ones.
+            if self.remainingCmds:
+                cancelRemainings()
+
+            if failure is not None:
+                self.status.conclude(failure=str(failure))
+                return onConcluded(failure)
+
+            self.status.conclude()
+            # pass SequenceAborted in that case.
+            onConcluded(exception.SequenceAborted() if self.status.isAborted else None)
+
+        def nextStep():
+            """Dispatch next subCommand(s), more than one if they belong to the same parallel group."""
+            try:
+                if self.status.isFlagged or not self.getNextSubCmd():
+                    return conclude()
+
+                subCmds = self.getNextSubCmds()
+            # building streamed subcommands can fail.
+            except Exception as e:
+                return conclude(e)
+
+            pending = list(subCmds)
+            failures = []
+
+            def onDone(subCmd, failure):
+                with lock:
+                    pending.remove(subCmd)
+                    if failure is not None:
+                        failures.append(failure)
+                    # waiting for the rest of the group.
+                    if pending:
+                        return
+
+                if failures:
+                    return conclude(failures[0])
+
+                # let other sequences use what is not needed anymore.
+                self.releaseUnusedResources()
+                nextStep()
+
+            for subCmd in subCmds:
+                try:
+                    subCmd.dispatch(cmd, functools.partial(onDone, subCmd))
+                except Exception as e:
+                    onDone(subCmd, e)
+
+        self.status.execute()
+        nextStep()
+
     def finalize(self):
         """Finalizing sequence."""
         cmd = self.getCmd()
         # insert sequence_status
         self.engine.opdb.insertSequenceStatus(sequence_id=self.sequence_id, status=self.status)
         # process tail, catch exception there, do not care.
-        for subCmd in self.tail:
+        for subCmds in Sequence.batched(self.tail):
             try:
-                subCmd.callAndUpdate(cmd)
+                self.callSubCmds(cmd, subCmds)
             except Exception as e:
                 cmd.warn(str(e))
 
+        # report how much was sent for that sequence.
+        self.emitter.genKeys(cmd)
+        # nothing left to resume.
+        self.engine.journal.end(self)
+
     def doAbort(self, cmd):
         """Aborting sequence now."""
         cmd.inform(f'text="aborting sequence({self.sequence_id}) !"')
-        # get current subcmd and abort.
-        current = self.getNextSubCmd()
-        if current:
+        # get current subcmd(s) and abort.
+        for current in self.getNextSubCmds():
             current.abort(cmd)
 
         # set flag to aborted and wait for the sequence to conclude.
@@ -185,10 +454,10 @@ class Sequence(list):
     def doFinish(self, cmd, now=False):
         """Finishing sequence now."""
         cmd.inform(f'text="finishing sequence({self.sequence_id}) !"')
-        # get current subcmd and finish now.
-        current = self.getNextSubCmd()
-        if current and now:
-            current.finishNow(cmd)
+        # get current subcmd(s) and finish now.
+        for current in self.getNextSubCmds():
+            if now:
+                current.finishNow(cmd)
 
         # set flag to aborted and wait for the sequence to conclude.
         self.status.setFlag(Flag.FINISHNOW, doWait=True)
@@ -197,13 +466,11 @@ class Sequence(list):
         """Declaring that this is the end for that sequence."""
         self.getCmd().finish()
         self.isAlive = False
+        self.status.notify()
 
     def waitWhileAlive(self, timeout=5):
         """Wait that the sequence is declared dead to finish."""
-        start = pfsTime.timestamp()
-
-        while self.isAlive and (pfsTime.timestamp() - start) < timeout:
-            pfsTime.sleep.millisec()
+        return self.status.waitFor(lambda: not self.isAlive, timeout=timeout)
 
     def instantiate(self, actor, cmdStr, **kwargs):
         """Prototype"""
@@ -228,6 +495,155 @@ class Sequence(list):
             self.group_id)
 
 
+class StreamingSequence(Sequence):
+    """Sequence whose subcommands are built from a generator, only when the cursor reaches them.
+
+    The generator adds subcommands using the regular Sequence API (add, expose...) and yields after each step, so a
+    step can make use of the results of the previous ones. The first step is built right away so that resources can
+    be inspected, which means that it must cover the whole sequence footprint.
+    """
+    # footprint of steps to come is not known, keep everything until the end.
+    incrementalRelease = False
+
+    def stream(self, steps, nExpected=None):
+        """Attach steps generator, nExpected being the expected total number of subcommands, if known."""
+        self.steps = steps
+        self.nExpected = nExpected
+        # build first step right away.
+        self.fetchMore()
+
+    def fetchMore(self):
+        """Build next step, return True if any subcommand was added."""
+        steps = getattr(self, 'steps', None)
+
+        if steps is None:
+            return False
+
+        nCmds = self.nCmds
+
+        while self.nCmds == nCmds:
+            try:
+                next(steps)
+            except StopIteration:
+                self.steps = None
+                break
+
+        # declare ids and generate keys for the new subcommands, only if the sequence is already active.
+        if self.sequence_id is not None:
+            self.declare([self.subCmdAt(id) for id in range(nCmds, self.nCmds)], start=nCmds)
+            # nothing more to come, tail can be numbered now.
+            if self.steps is None:
+                self.declareTail()
+
+            self.genStepsKey(self.getCmd())
+
+        return self.nCmds > nCmds
+
+    def activate(self):
+        """Declare sequence as active and generate steps key, tail is declared once the stream is exhausted."""
+        self.declare(self.cmdList)
+        self.status.ready()
+
+        if self.steps is None:
+            self.declareTail()
+
+        self.genStepsKey(self.getCmd())
+
+    def declareTail(self):
+        """Number tail after the last streamed subcommand, so that ids never collide."""
+        if any(subCmd.id == -1 for subCmd in self.tail):
+            self.declare(self.tail, start=self.nCmds)
+
+    def finalize(self):
+        """Stream might have been interrupted, stop it and declare tail before processing it."""
+        self.steps = None
+        self.declareTail()
+        Sequence.finalize(self)
+
+    def genStepsKey(self, cmd):
+        """Generate sequenceSteps keyword, -1 meaning unknown."""
+        self.remaining.sync()
+        nExpected = -1 if self.nExpected is None else self.nExpected
+        nRemaining = -1 if self.nExpected is None else nExpected - self.nCmds + self.remaining.count
+        cmd.inform(f'sequenceSteps={self.sequence_id},{self.nCmds},{nExpected},{nRemaining}')
+
+
+class RemainingCounters(object):
+    """Counters over the subcommands which have not been called yet, maintained incrementally."""
+
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything, next sync will count all subcommands again."""
+        with self.lock:
+            self.nHead = 0
+            self.nBody = 0
+            self.count = 0
+            self.timeLim = 0
+            self.byType = collections.Counter()
+            self.resources = collections.Counter()
+            self.nUnknownFootprint = 0
+            self.sequence.cursor = 0
+
+    def sync(self):
+        """Count subcommands added since last sync."""
+        head, body = self.sequence.head, self.sequence
+
+        with self.lock:
+            # head has been extended, indexes have shifted, so count everything again.
+            if len(head) != self.nHead:
+                self.reset()
+                for subCmd in head:
+                    self.register(subCmd)
+                self.nHead = len(head)
+
+            for subCmd in list.__getitem__(body, slice(self.nBody, None)):
+                self.register(subCmd)
+
+            self.nBody = len(body)
+
+    def register(self, subCmd):
+        """Count a new subcommand, if not already called."""
+        subCmd.counted = None
+
+        if subCmd.cmdRet.wasCalled:
+            return
+
+        resources = None if subCmd.resources is None else [Resource.translate(name)[0] for name in subCmd.resources]
+        timeLim = subCmd.effectiveTimeLim
+        subCmd.counted = (timeLim, resources)
+
+        self.count += 1
+        self.timeLim += timeLim
+        self.byType[type(subCmd)] += 1
+
+        if resources is None:
+            self.nUnknownFootprint += 1
+        else:
+            self.resources.update(resources)
+
+    def update(self, subCmd):
+        """Discount subcommand, once it has been called."""
+        with self.lock:
+            if subCmd.counted is None or not subCmd.cmdRet.wasCalled:
+                return
+
+            timeLim, resources = subCmd.counted
+            subCmd.counted = None
+
+            self.count -= 1
+            self.timeLim -= timeLim
+            self.byType[type(subCmd)] -= 1
+
+            if resources is None:
+                self.nUnknownFootprint -= 1
+            else:
+                self.resources.subtract(resources)
+
+
 class CmdList(list):
     def __init__(self, sequence, cmdList):
         super().__init__()
@@ -1,5 +1,6 @@
+import threading
+
 import fysom
-import ics.utils.time as pfsTime
 
 
 class Flag(object):
@@ -23,6 +24,8 @@ class Status(fysom.Fysom):
     def __init__(self):
         self.flag = None
         self.output = None
+        # notify waiters on state transitions.
+        self.condition = threading.Condition()
 
         events = [{'name': 'init', 'src': 'none', 'dst': 'INIT'},
                   {'name': 'ready', 'src': 'INIT', 'dst': 'READY'},
@@ -62,6 +65,16 @@ class Status(fysom.Fysom):
         """for opdb."""
         return dict(status_flag=self.flag, cmd_output=self.output)
 
+    def notify(self):
+        """Wake up every thread waiting on that status."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def waitFor(self, predicate, timeout=None):
+        """Block until predicate() is True or timeout expires, return the last evaluation of predicate."""
+        with self.condition:
+            return self.condition.wait_for(predicate, timeout=timeout)
+
     def setFlag(self, flag, doWait=False):
         """Set status flag."""
         # don't change the flag, if sequence already concluded.
@@ -71,8 +84,8 @@ class Status(fysom.Fysom):
         self.flag = flag
 
         # wait until sequence is concluded, useful when called from another thread.
-        while doWait and self.isActive:
-            pfsTime.sleep.millisec()
+        if doWait:
+            self.waitFor(lambda: not self.isActive)
 
     def conclude(self, failure=''):
         """Conclude the sequence, drive the state machine to either abort, finish or fail"""
@@ -97,3 +110,6 @@ class Status(fysom.Fysom):
             self.abort()
         else:
             raise KeyError(f'unknown flag :{self.flag}')
+
+        # sequence is not active anymore.
+        self.notify()
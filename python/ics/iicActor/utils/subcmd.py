@@ -1,7 +1,12 @@
+import queue
+import time
+
 import ics.utils.cmd as cmdUtils
 from ics.iicActor.utils.exception import IicException
 from ics.iicActor.utils.lib import stripQuotes
+from opscore.actor import keyvar
 from opscore.utility.qstr import qstr
+from twisted.internet import reactor
 
 
 class CmdRet(object):
@@ -50,6 +55,16 @@ class SubCmd(object):
         self.cmdStr = cmdStr
         self.cmdHead = cmdStr if cmdStr.find(' ') == -1 else cmdStr[:cmdStr.find(' ')]
         self.timeLim = timeLim
+        # subcommands sharing the same parallelGroup are dispatched concurrently.
+        self.parallelGroup = sequence.parallelGroup
+        # resource footprint, set by ResourceManager.inspect(), None if unknown.
+        self.resources = None
+        # what RemainingCounters has counted for that subcommand, None if not counted.
+        self.counted = None
+        # dispatch, first reply and completion times, for the ledger.
+        self.timestamps = (None, None, None)
+        # timeLim actually sent with the last call, for the ledger.
+        self.sentTimeLim = None
 
         # initialize empty cmdRet
         self.id = -1
@@ -62,6 +77,20 @@ class SubCmd(object):
     def fullCmd(self):
         return f'{self.actor} {self.cmdStr}'.strip()
 
+    @property
+    def effectiveTimeLim(self):
+        """timeLim from call history in adaptive mode, static timeLim if disabled or not enough history."""
+        engine = self.sequence.engine
+        config = dict() if engine is None else engine.config
+
+        if not config.get('adaptiveTimeLim', False):
+            return self.timeLim
+
+        timeLim = engine.ledger.estimate(self, factor=config.get('timeLimFactor', 1.5),
+                                         minSamples=config.get('timeLimMinSamples', 5),
+                                         floor=config.get('timeLimFloor', 10))
+        return self.timeLim if timeLim is None else timeLim
+
     @property
     def iicActor(self):
         return self.sequence.engine.actor
@@ -72,16 +101,80 @@ class SubCmd(object):
 
     def build(self, cmd):
         """ Build kwargs for actorcore.CmdrConnection.Cmdr.call(**kwargs) """
-        return dict(actor=self.actor, cmdStr=self.cmdStr, forUserCmd=self.forUserCmd(cmd), timeLim=self.timeLim)
+        return dict(actor=self.actor, cmdStr=self.cmdStr, forUserCmd=self.forUserCmd(cmd),
+                    timeLim=self.effectiveTimeLim)
+
+    def setCmdRet(self, cmdRet):
+        """Set cmdRet and let the sequence update its counters."""
+        self.cmdRet = cmdRet
+        self.sequence.remaining.update(self)
+        self.sequence.engine.journal.update(self)
+
+        # record round-trip, only for actual calls.
+        if self.timestamps[0] is not None:
+            self.sequence.engine.ledger.record(self, nReplies=len(cmdRet.replyList))
 
     def callAndUpdate(self, cmd):
         """"""
-        self.cmdRet = self.call(cmd)
+        self.setCmdRet(self.call(cmd))
         self.handleOutput()
 
     def call(self, cmd):
         """ Call subcommand, handle reply and generate status """
-        cmdVar = self.iicActor.cmdr.call(**(self.build(cmd=cmd)))
+        done = queue.Queue()
+        self.send(cmd, done.put)
+        return self.processReply(cmd, done.get())
+
+    def dispatch(self, cmd, callback):
+        """Non-blocking call, callback(failure) is fired once the subcommand is done, failure being None on success."""
+        self.bgCall(cmd, lambda cmdVar: self.notify(callback, lambda: self.processReply(cmd, cmdVar)))
+
+    def bgCall(self, cmd, onDone):
+        """Call through cmdr.bgCall, onDone(cmdVar) is processed by the engine executor once the subcommand is done."""
+        # journal, ledger and keywords are written from there, keep that out of the reactor thread.
+        self.send(cmd, lambda cmdVar: self.iicActor.engine.executor.resume(onDone, cmdVar))
+
+    def send(self, cmd, onDone):
+        """Send subcommand and time every reply, onDone(cmdVar) is fired from the reactor thread once done."""
+
+        def onReply(cmdVar):
+            self.markReply(cmdVar.isDone)
+
+            if cmdVar.isDone:
+                onDone(cmdVar)
+
+        kwargs = self.build(cmd=cmd)
+        self.sentTimeLim = kwargs['timeLim']
+
+        self.markDispatched()
+        reactor.callFromThread(self.iicActor.cmdr.bgCall, callFunc=onReply, callCodes=keyvar.AllCodes, **kwargs)
+
+    def markDispatched(self):
+        """Reset round-trip timestamps."""
+        self.timestamps = (time.time(), None, None)
+
+    def markReply(self, isDone):
+        """Set first reply time, only once, and completion time."""
+        dispatchedAt, firstReplyAt, completedAt = self.timestamps
+        now = time.time()
+
+        firstReplyAt = now if firstReplyAt is None else firstReplyAt
+        completedAt = now if isDone else completedAt
+
+        self.timestamps = (dispatchedAt, firstReplyAt, completedAt)
+
+    def notify(self, callback, getCmdRet):
+        """Set cmdRet from getCmdRet(), handle output and fire callback(failure)."""
+        try:
+            self.setCmdRet(getCmdRet())
+            self.handleOutput()
+        except Exception as e:
+            return callback(e)
+
+        callback(None)
+
+    def processReply(self, cmd, cmdVar):
+        """Convert cmdVar to CmdRet and report warnings."""
         cmdRet = CmdRet.fromCmdVar(cmdVar)
 
         # report warnings
@@ -101,13 +194,12 @@ class SubCmd(object):
 
     def genKeys(self, cmd):
         """"""
-        genKeys = cmd.warn if self.cmdRet.didFail else cmd.inform
-        genKeys(str(self))
+        self.sequence.emitter.update(cmd, self)
 
     def init(self, id, cmd):
         """"""
         self.id = id
-        self.genKeys(cmd)
+        self.sequence.emitter.declare(cmd, [self])
 
     def cancel(self, cmd):
         """"""
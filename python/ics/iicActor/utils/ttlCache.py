@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class TtlCache(object):
+    """Thread-safe key/value cache whose entries expire after ttl seconds."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = dict()
+
+        self.nHits = 0
+        self.nMisses = 0
+
+    def __str__(self):
+        return f'{len(self.entries)},{self.nHits},{self.nMisses}'
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+
+    def get(self, key, load):
+        """Return cached value for key, call load() and cache its output if missing or expired."""
+        with self.lock:
+            value, expiresAt = self.entries.get(key, (None, 0))
+
+            if time.monotonic() < expiresAt:
+                self.nHits += 1
+                return value
+
+            self.nMisses += 1
+
+        # loading outside the lock, so that a slow query does not block other keys.
+        value = load()
+        self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop a single key, or everything if key is None."""
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
@@ -42,7 +42,8 @@ class VisitedCmd(SubCmd):
 
     def build(self, cmd):
         """ Build kwargs for actorcore.CmdrConnection.Cmdr.call(**kwargs), format with self.visitId """
-        return dict(actor=self.actor, cmdStr=self.cmdStrAndVisit, forUserCmd=self.forUserCmd(cmd), timeLim=self.timeLim)
+        return dict(actor=self.actor, cmdStr=self.cmdStrAndVisit, forUserCmd=self.forUserCmd(cmd),
+                    timeLim=self.effectiveTimeLim)
 
     def allocateFrameId(self):
         """Allocate frameId only once."""
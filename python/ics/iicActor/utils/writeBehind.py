@@ -0,0 +1,199 @@
+import collections
+import itertools
+import logging
+import threading
+import time
+
+import sqlalchemy
+
+from ics.iicActor.utils import exception
+from ics.iicActor.utils.jsonLines import JsonLines, localPath
+
+
+class WriteBehindQueue(object):
+    """Ordered background writer for non-critical opdb inserts, journaled locally first so nothing is lost."""
+
+    def __init__(self, opdb, path, deadPath, maxAttempts=10, maxDelay=60, maxBatch=50):
+        self.opdb = opdb
+        self.path = path
+        self.maxAttempts = int(maxAttempts)
+        self.maxDelay = maxDelay
+        self.maxBatch = int(maxBatch)
+        self.logger = logging.getLogger('writeBehind')
+        self.file = JsonLines(path, logger=self.logger)
+        # entries which could not be written, kept for a manual insert.
+        self.deadLetters = JsonLines(deadPath, logger=self.logger)
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.entryIds = itertools.count(1)
+
+        self.nWritten = 0
+        self.nRetries = 0
+        self.nDropped = 0
+        # what written entries returned, visit_set outcomes mostly, by (method, outcome).
+        self.outcomes = collections.Counter()
+
+        # whatever was not written before the last shutdown comes first.
+        self.recover()
+
+        self.writer = threading.Thread(target=self.work, name='opdbWriteBehind', daemon=True)
+        self.writer.start()
+
+    def __str__(self):
+        return f'opdbWriteBehind={len(self.pending)},{self.nWritten},{self.nRetries},{self.nDropped}'
+
+    @classmethod
+    def fromConfig(cls, opdb, config):
+        """Queue journaled at config['writeBehindPath'], ~/.iic/opdbWriteBehind.jsonl by default."""
+        return cls(opdb, localPath(config, 'writeBehindPath', 'opdbWriteBehind.jsonl'),
+                   localPath(config, 'writeBehindDeadPath', 'opdbWriteBehind.dead.jsonl'),
+                   maxAttempts=config.get('writeBehindMaxAttempts', 10))
+
+    def journal(self, record):
+        """Append record to the local journal, flushed right away."""
+        self.file.append(record)
+
+    def recover(self):
+        """Reload entries which were queued but never written, and compact the journal."""
+        queued = dict()
+
+        for record in self.file.read():
+            if record['event'] == 'queued':
+                queued[record['entryId']] = record
+            else:
+                queued.pop(record['entryId'], None)
+
+        # entry ids are only unique within a session, renumber.
+        self.pending = [dict(record, entryId=next(self.entryIds)) for record in queued.values()]
+
+        self.file.rewrite(self.pending)
+
+        if self.pending:
+            self.logger.info(f'recovered {len(self.pending)} opdb inserts from {self.path}')
+
+    def submit(self, method, **kwargs):
+        """Journal and queue opdb.method(**kwargs)."""
+        with self.condition:
+            record = dict(event='queued', entryId=next(self.entryIds), method=method, kwargs=kwargs)
+            self.journal(record)
+            self.pending.append(record)
+            self.condition.notify_all()
+
+    @staticmethod
+    def rowKey(record):
+        """Table and columns of a plain insert entry, None for any other entry."""
+        if record['method'] != 'insert':
+            return None
+
+        kwargs = dict(record['kwargs'])
+        return kwargs.pop('table'), tuple(kwargs.keys())
+
+    def nextBatch(self):
+        """Return the first pending entry, along with the following plain inserts into the same table."""
+        batch = self.pending[:1]
+        key = WriteBehindQueue.rowKey(batch[0])
+
+        for record in self.pending[1:self.maxBatch]:
+            if key is None or WriteBehindQueue.rowKey(record) != key:
+                break
+            batch.append(record)
+
+        return batch
+
+    def work(self):
+        """Writer loop, process entries in order forever."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                batch = self.nextBatch()
+
+            self.process(batch)
+
+            with self.condition:
+                del self.pending[:len(batch)]
+                self.condition.notify_all()
+
+    def write(self, batch):
+        """Write entries, plain inserts into the same table go in a single statement, return single entry output."""
+        if len(batch) == 1:
+            [record] = batch
+            return getattr(self.opdb, record['method'])(**record['kwargs'])
+
+        table, columns = WriteBehindQueue.rowKey(batch[0])
+        rows = [tuple([record['kwargs'][column] for column in columns]) for record in batch]
+        self.opdb.insertRows(table, columns, rows)
+
+    def written(self, batch, outcome):
+        """Journal and count written entries."""
+        self.nWritten += len(batch)
+        for record in batch:
+            self.journal(dict(event='written', entryId=record['entryId']))
+
+        if outcome is not None:
+            self.outcomes[(batch[0]['method'], str(outcome))] += 1
+            self.logger.info(f'{batch[0]["method"]} {batch[0]["kwargs"]} : {outcome}')
+
+    @staticmethod
+    def isTransient(e):
+        """Return True if the connection to opdb was lost, any other error would fail again the same way."""
+        while e is not None:
+            if isinstance(e, sqlalchemy.exc.DBAPIError) and (e.connection_invalidated or isinstance(e, (
+                    sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError))):
+                return True
+            # OpdbInsertFailed is raised while handling the original exception.
+            e = e.__cause__ or e.__context__
+
+        return False
+
+    def process(self, batch):
+        """Write a batch of entries, retrying with exponential backoff only while opdb cannot be reached."""
+        for attempt in range(self.maxAttempts):
+            try:
+                return self.written(batch, self.write(batch))
+            except Exception as e:
+                reason = e
+
+            if not WriteBehindQueue.isTransient(reason):
+                break
+
+            self.nRetries += 1
+            self.logger.warning(f'{batch[0]["method"]} failed with {reason}, retrying...')
+            self.genKeys()
+            time.sleep(min(2 ** attempt, self.maxDelay))
+
+        else:
+            return self.drop(batch, reason)
+
+        # a single bad row fails the whole statement, do not drop the others along with it.
+        if len(batch) > 1:
+            self.logger.warning(f'{len(batch)} rows insert failed with {reason}, writing them one by one...')
+            for record in batch:
+                self.process([record])
+            return
+
+        self.drop(batch, reason)
+
+    def drop(self, batch, reason):
+        """Give up on entries, which are kept in the dead-letter file so they can be inserted by hand."""
+        self.nDropped += len(batch)
+
+        for record in batch:
+            self.deadLetters.append(dict(record, event='dropped', reason=str(reason)))
+            self.journal(dict(event='dropped', entryId=record['entryId']))
+
+        self.opdb.engine.actor.bcast.warn(f'text="{str(exception.OpdbInsertFailed(batch[0]["method"], reason))}"')
+        self.genKeys()
+
+    def flush(self, timeout=None):
+        """Wait for all pending entries to be written, return True if the queue is empty."""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending, timeout=timeout)
+
+    def genKeys(self, cmd=None):
+        """Generate opdbWriteBehind keyword."""
+        cmd = self.opdb.engine.actor.bcast if cmd is None else cmd
+        cmd.inform(str(self))
+
+        for (method, outcome), count in sorted(self.outcomes.items()):
+            cmd.inform(f'opdbWriteBehindOutcome={method},{outcome},{count}')